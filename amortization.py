@@ -0,0 +1,168 @@
+from datetime import date, datetime
+
+import numpy as np
+from dateutil.parser import parse as parse_date
+
+EPOCH_MONTH = 1970 * 12
+MONTH_DAYS = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def to_month_index(values):
+    return np.fromiter((value.year * 12 + value.month - 1 - EPOCH_MONTH for value in values), dtype=np.int64, count=len(values))
+
+
+def days_in_month(month_index):
+    # Integer arithmetic only, datetime64 conversions dominate on long timelines
+    month_index = np.asarray(month_index)
+    year, month = month_index // 12 + 1970, month_index % 12
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    return MONTH_DAYS[month] + ((month == 1) & leap)
+
+
+# Expected-payment schedules of many records as parallel NumPy arrays. A record
+# is paid in `months` monthly installments of `payment_amount` on
+# `payment_day` (clamped to the month length), the last one due in the month of
+# `last_date` and taking whatever is left of `amount`.
+class PaymentSchedule:
+    def __init__(self, ids, is_lend, amount, months, payment_amount, payment_day, last_date):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.is_lend = np.asarray(is_lend, dtype=bool)
+        self.amount = np.asarray(amount, dtype=np.float64)
+        self.months = np.maximum(np.asarray(months, dtype=np.int64), 1)
+        self.payment_amount = np.asarray(payment_amount, dtype=np.float64)
+        self.payment_day = np.clip(np.asarray(payment_day, dtype=np.int64), 1, 31)
+        self.last_month = to_month_index(last_date)
+        self.first_month = self.last_month - self.months + 1
+
+    @classmethod
+    def from_rows(cls, rows):
+        # Transposed once into columns, each becomes an array without a Python
+        # pass per row and field. `is_lend` is compared in SQL for the same reason.
+        columns = dict(zip(rows[0]._fields, zip(*rows))) if rows else {}
+
+        def column(name):
+            return columns.get(name, ())
+
+        return cls(
+            column('id'),
+            column('is_lend'),
+            column('amount'),
+            column('months'),
+            column('payment_amount'),
+            column('payment_day'),
+            column('last_date'),
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_due_dates(self, month_index, payment_day):
+        day = np.minimum(payment_day, days_in_month(month_index))
+        return np.asarray(month_index).astype('datetime64[M]').astype('datetime64[D]') + (day - 1)
+
+    def get_expected_paid(self, count, index=slice(None)):
+        # Total that should have been paid after `count` installments
+        scheduled = np.minimum(self.payment_amount[index] * count, self.amount[index])
+        return np.where(count >= self.months[index], self.amount[index], np.maximum(scheduled, 0))
+
+    def get_installment(self, number, index=slice(None)):
+        return self.get_expected_paid(number + 1, index) - self.get_expected_paid(number, index)
+
+    def get_due_count(self, as_of):
+        month = as_of.year * 12 + as_of.month - 1 - EPOCH_MONTH
+        due_day = np.minimum(self.payment_day, days_in_month(month))
+        count = month - self.first_month + (as_of.day >= due_day)
+
+        return np.clip(count, 0, self.months)
+
+    def get_timeline(self):
+        index = np.repeat(np.arange(len(self)), self.months)
+        starts = np.repeat(np.cumsum(self.months) - self.months, self.months)
+        number = np.arange(len(index)) - starts
+        month = self.first_month[index] + number
+        installment = self.get_installment(number, index)
+
+        return {
+            'position': index,
+            'record_id': self.ids[index],
+            'number': number,
+            'due_date': self.get_due_dates(month, self.payment_day[index]),
+            'amount': installment,
+            'balance': self.amount[index] - self.get_expected_paid(number + 1, index),
+        }
+
+    def get_arrears(self, paid, as_of):
+        # Installments of the timeline due by `as_of`, summed per record and
+        # checked against the recorded payments
+        timeline = self.get_timeline()
+        due = timeline['due_date'] <= np.datetime64(as_of, 'D')
+        expected = np.bincount(timeline['position'][due], weights=timeline['amount'][due], minlength=len(self))
+
+        return np.maximum(expected - paid, 0)
+
+    def get_paid_count(self, paid):
+        # Installments covered by the paid total, the largest count whose
+        # get_expected_paid is within it. Before the last one that is
+        # min(payment_amount * count, amount), so without a payment_amount only
+        # the last installment, holding the whole amount, is left to cover.
+        paid = np.asarray(paid, dtype=np.float64)
+        covered = np.floor(paid / np.maximum(self.payment_amount, 1e-9) + 1e-9).astype(np.int64)
+        count = np.where(self.payment_amount > 0, np.minimum(covered, self.months - 1), self.months - 1)
+
+        return np.where(paid >= self.amount - 1e-9, self.months, np.maximum(count, 0))
+
+    def get_next_due_by_paid(self, paid):
+        # The first installment the paid total does not cover yet, so the due
+        # date only moves forward when payments are recorded
+        count = self.get_paid_count(paid)
+        active = count < self.months
+        month = self.first_month + np.minimum(count, self.months - 1)
+        due_dates = self.get_due_dates(month, self.payment_day).astype('datetime64[s]').astype(datetime)
+
+        return [due_date if is_active else None for due_date, is_active in zip(due_dates, active)]
+
+    @staticmethod
+    def get_months(as_of, horizon):
+        start = as_of.year * 12 + as_of.month - 1 - EPOCH_MONTH
+        return [date.fromisoformat(f'{month}-01') for month in np.arange(start, start + horizon).astype('datetime64[M]')]
+
+    def get_pending(self, as_of, horizon):
+        # Installments still to come in each of the next `horizon` months, one
+        # row per month and one column per record
+        start = as_of.year * 12 + as_of.month - 1 - EPOCH_MONTH
+        count = self.get_due_count(as_of)
+        pending = np.zeros((horizon, len(self)))
+
+        for offset in range(horizon):
+            number = start + offset - self.first_month
+            due = (number >= count) & (number < self.months)
+            pending[offset] = np.where(due, self.get_installment(np.maximum(number, 0)), 0)
+
+        return pending
+
+    def get_forecast(self, as_of, horizon):
+        # Pending installments split into incoming (lends) and outgoing (borrows)
+        pending = self.get_pending(as_of, horizon)
+        incoming = pending[:, self.is_lend].sum(axis=1)
+        outgoing = pending[:, ~self.is_lend].sum(axis=1)
+
+        return [
+            (month, float(inflow), float(outflow))
+            for month, inflow, outflow in zip(self.get_months(as_of, horizon), incoming, outgoing)
+        ]
+
+def get_next_due_date(amount, months, payment_amount, payment_day, last_date, paid_total=0):
+    if isinstance(last_date, str):
+        last_date = parse_date(last_date)
+
+    schedule = PaymentSchedule(
+        [0],
+        [True],
+        [float(amount)],
+        [int(months)],
+        [float(payment_amount)],
+        [int(payment_day)],
+        [last_date],
+    )
+
+    return schedule.get_next_due_by_paid([paid_total])[0]
@@ -1,13 +1,10 @@
 import logging
-import requests
 import threading
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
 from config import AppConfig
-from scheduler import run_schedule
-from rates_handler import RatesHandler
 
 db = SQLAlchemy()
 
@@ -20,24 +17,20 @@ db.init_app(app)
 
 from views import *
 from models import *
-
-with app.app_context():
-    db.create_all()
-    db.session.commit()
+from commands import *
 
 
+# Development server with the scheduled jobs in a thread. In production the app
+# is served by gunicorn (gunicorn.conf.py) and the jobs run in `python jobs.py`.
 if __name__ == '__main__':
-    rh = RatesHandler()
+    from migrations import migrate
 
-    # Schedule the rate fetching and storing to Redis every hour
-    t = threading.Thread(target=run_schedule, args=(rh.update_rates,))
-    t.start()
+    with app.app_context():
+        migrate(log=app.logger.info)
 
-    url = f'{AppConfig.SERVER_URL}/{AppConfig.TELEGRAM_BOT_TOKEN}'
-    requests.post(AppConfig.TELEGRAM_URL + 'setWebhook', json={'url': url})
+    from jobs import run_jobs
 
-    from bot import bot
-    bot.remove_webhook()
-    bot.set_webhook(url=f'{AppConfig.SERVER_URL}/{AppConfig.TELEGRAM_TOKEN}')
+    t = threading.Thread(target=run_jobs, daemon=True)
+    t.start()
 
     app.run(host=AppConfig.HOST, port=AppConfig.PORT)
@@ -0,0 +1,134 @@
+import json
+import math
+import statistics
+import time
+from types import SimpleNamespace
+
+from app import app, db
+from datagen import generate_data
+from metrics import track_queries
+from models import User, Record, Payment, TypeEnum
+from services import RecordService, PaymentService, ForecastService
+
+
+def get_sample(connection):
+    # The user with the most records: list and page calls see the worst case
+    user_id = connection.execute(
+        db.select(Record.user_id).group_by(Record.user_id).order_by(db.func.count().desc()).limit(1)
+    ).scalar()
+    user = connection.execute(db.select(User).where(User.id == user_id)).one()
+
+    return SimpleNamespace(
+        user=SimpleNamespace(id=int(user.tg_id), first_name=user.first_name, is_bot=False,
+                             language_code=user.language_code, last_name=user.last_name, username=user.username),
+        user_id=user.id,
+        record_id=connection.execute(db.select(db.func.max(Record.id)).where(Record.user_id == user.id)).scalar(),
+        payment_id=connection.execute(db.select(db.func.max(Payment.id))).scalar(),
+    )
+
+
+def get_cases(sample):
+    client = app.test_client()
+
+    with client.session_transaction() as session:
+        session['username'] = 'benchmark'
+
+    def get(url):
+        def case():
+            response = client.get(url)
+            assert response.status_code == 200, f'GET {url}: {response.status_code}'
+
+        return case
+
+    def call(service, method, *args):
+        return lambda: getattr(service(sample.user), method)(*args)
+
+    return {
+        'GET /users': get('/users'),
+        'GET /users/<id>': get(f'/users/{sample.user_id}'),
+        'GET /records': get('/records'),
+        'GET /records/<id>': get(f'/records/{sample.record_id}'),
+        'GET /payments': get('/payments'),
+        'GET /payments/<id>': get(f'/payments/{sample.payment_id}'),
+        'RecordService.get_records': call(RecordService, 'get_records', TypeEnum.LEND.value),
+        'RecordService.get_record': call(RecordService, 'get_record', sample.record_id),
+        'RecordService.get_records_page': call(RecordService, 'get_records_page', TypeEnum.LEND.value, {}),
+        'PaymentService.get_payments': call(PaymentService, 'get_payments'),
+        'PaymentService.get_payment': call(PaymentService, 'get_payment', sample.payment_id),
+        'PaymentService.get_payments_page': call(PaymentService, 'get_payments_page', {}),
+        'ForecastService.get_portfolio (user)': lambda: ForecastService(sample.user_id).get_portfolio(),
+        'ForecastService.get_portfolio (all)': lambda: ForecastService().get_portfolio(),
+    }
+
+
+def time_case(case, repeat):
+    durations, queries = [], 0
+
+    for attempt in range(repeat + 1):
+        with app.app_context(), track_queries('benchmark') as scope:
+            start = time.perf_counter()
+            case()
+            duration = time.perf_counter() - start
+
+        # The first call warms up connections and caches
+        if attempt:
+            durations.append(duration)
+            queries = scope.queries
+
+    durations.sort()
+
+    return {
+        'median_ms': round(statistics.median(durations) * 1000, 3),
+        'p95_ms': round(durations[max(0, math.ceil(0.95 * len(durations)) - 1)] * 1000, 3),
+        'queries': queries,
+    }
+
+
+def count_rows(connection):
+    return {model.__tablename__: connection.execute(db.select(db.func.count()).select_from(model)).scalar()
+            for model in (User, Record, Payment)}
+
+
+# The database grows to every scale in turn (users in total, generated rows
+# are kept), and every case is timed at each of them
+def run_benchmark(scales, repeat=20, records=5.0, payments=4.0, log=print):
+    with app.app_context():
+        report = {'database': db.engine.dialect.name, 'repeat': repeat, 'scales': {}, 'results': {}}
+
+        for scale in sorted(scales):
+            with db.engine.connect() as connection:
+                if (missing := scale - count_rows(connection)['user']) > 0:
+                    log(f'Generating {missing} users')
+                    generate_data(connection, missing, records, payments, seed=scale, log=lambda message: None)
+                elif missing < 0:
+                    log(f'The database already has {-missing} users more than {scale}, use an empty one to compare runs')
+
+                report['scales'][scale] = count_rows(connection)
+                sample = get_sample(connection)
+
+            log(f'Scale {scale}: {report["scales"][scale]}')
+
+            for name, case in get_cases(sample).items():
+                report['results'].setdefault(name, {})[scale] = result = time_case(case, repeat)
+                log(f'  {name:<40} {result["median_ms"]:>10} ms  p95 {result["p95_ms"]:>10} ms  '
+                    f'{result["queries"]} queries')
+
+    return report
+
+
+def compare_reports(report, previous):
+    lines = []
+
+    for name, results in report['results'].items():
+        for scale, result in results.items():
+            if before := previous['results'].get(name, {}).get(str(scale)):
+                change = (result['median_ms'] / before['median_ms'] - 1) * 100 if before['median_ms'] else 0
+                lines.append(f'{name:<40} {scale:>8}  {before["median_ms"]:>10} -> {result["median_ms"]:>10} ms '
+                             f'({change:+.1f}%)  queries {before["queries"]} -> {result["queries"]}')
+
+    return lines
+
+
+def write_report(report, path):
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
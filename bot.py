@@ -1,30 +1,87 @@
 import json
+import time
+from collections import defaultdict
 
 import telebot
-from telebot import types
-from datetime import datetime as dt
+from telebot import apihelper, types
+from telebot.handler_backends import RedisHandlerBackend
+from datetime import datetime as dt, timezone
 from prettytable import PrettyTable
 
 from app import app
+from callback_data import CallbackDataException, decode_callback, encode_callback
 from config import AppConfig
+from dispatcher import Dispatcher
+from http_client import http_client
+from models import TypeEnum
 from services import WeatherService, WeatherServiceException, UserService, RecordService, RecordServiceException, \
-    PaymentService, PaymentServiceException
+    PaymentService, PaymentServiceException, ForecastService, ForecastServiceException, ReminderService, \
+    render_cache
+from rates_alerts import RatesAlertsException
 from rates_handler import RatesHandler
+from send_queue import SendQueue
 
 commands = ('<b>Available commands:</b>\n'
             '/start - initialize main menu\n'
             '/help - show available commands\n'
-            '/rates - get BTC and ETH rates\n'
+            '/rates - get currency rates\n'
+            '/alert - notify when a rate crosses a price, e.g. /alert BTCUSDT above 70000\n'
             '/weather - get weather in entered city\n'
             '/lends - show your lends\n'
             '/borrows - show your borrows\n'
             '/payments - show your payments\n'
             '/record - show record detail by id\n'
             '/payment - show payment detail by id\n'
+            '/forecast - show arrears and expected payments\n'
             '/add - create new lend or borrow record\n'
             '/pay - create new payment')
 
-bot = telebot.TeleBot(AppConfig.TELEGRAM_TOKEN)
+apihelper.CUSTOM_REQUEST_SENDER = http_client.request
+apihelper.API_URL = f'{AppConfig.TELEGRAM_API_URL}/bot{{0}}/{{1}}'
+
+# Updates already arrive on the ordered update queue workers. Next-step handlers
+# are kept in Redis, a flow's next message may be handled by another web worker.
+bot = telebot.TeleBot(AppConfig.TELEGRAM_TOKEN, threaded=False, next_step_backend=RedisHandlerBackend(
+    host=AppConfig.REDIS_HOST or 'localhost',
+    port=AppConfig.REDIS_PORT or 6379,
+    prefix='bot:next_step',
+))
+dispatcher = Dispatcher('bot')
+send_queue = SendQueue('bot', f'{AppConfig.TELEGRAM_API_URL}/bot{AppConfig.TELEGRAM_TOKEN}/')
+
+
+def get_markup(markup):
+    # Reply keyboards only serialize to a JSON string, inline ones also to a dict
+    return markup if isinstance(markup, dict) else json.loads(markup.to_json())
+
+
+def send_message(chat_id, text, parse_mode=None, reply_markup=None, reply_to_message_id=None):
+    # Goes through the rate limited send queue instead of calling the API inline
+    payload = {'chat_id': chat_id, 'text': text}
+
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
+    if reply_markup:
+        payload['reply_markup'] = get_markup(reply_markup)
+    if reply_to_message_id:
+        payload['reply_to_message_id'] = reply_to_message_id
+
+    return send_queue.put(chat_id, 'sendMessage', payload)
+
+
+def edit_message(message, text, parse_mode=None, reply_markup=None):
+    payload = {'chat_id': message.chat.id, 'message_id': message.message_id, 'text': text}
+
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
+    if reply_markup:
+        payload['reply_markup'] = get_markup(reply_markup)
+
+    return send_queue.put(message.chat.id, 'editMessageText', payload)
+
+
+def reply_to(message, text, **kwargs):
+    return send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
 
 
 def create_user(data):
@@ -35,43 +92,120 @@ def create_user(data):
 
 def send_rates(message):
     rh = RatesHandler()
-    rates = rh.get_stored_rates()
-    text = f'<b>Rates</b>\nBTC/USDT: {rates.get("BTCUSDT")}\nETH/USDT: {rates.get("ETHUSDT")}'
+    text = rh.get_rates_text()
+
+    send_message(message.chat.id, text, parse_mode='HTML')
+
 
-    bot.send_message(message.chat.id, text, parse_mode='HTML')
+def subscribe_alert(message):
+    args = message.text.split()[1:]
+
+    if len(args) != 3:
+        send_message(message.chat.id, 'Use format: /alert <pair> <above|below> <price>\n'
+                                          'Example: /alert BTCUSDT above 70000')
+        return
+
+    rh = RatesHandler()
+    pair, direction = args[0].upper(), args[1].lower()
+
+    if pair not in rh.CURRENCY_PAIRS:
+        send_message(message.chat.id, f'Available pairs: {", ".join(rh.CURRENCY_PAIRS)}')
+        return
+
+    try:
+        threshold = rh.alerts.subscribe(message.chat.id, pair, direction, args[2])
+    except RatesAlertsException as rae:
+        send_message(message.chat.id, str(rae))
+    else:
+        send_message(message.chat.id, f'You will be notified when {pair} is {direction} {threshold:g}')
+
+
+def send_alerts(fired):
+    # One message per chat with every alert it had crossed on this tick
+    for chat_id, alerts in fired.items():
+        lines = [f'{pair} is {direction} {threshold:g}: {price:g}' for pair, direction, threshold, price in alerts]
+        try:
+            send_message(chat_id, '<b>Rate alerts</b>\n' + '\n'.join(lines), parse_mode='HTML')
+        except Exception as error:
+            app.logger.error(f'Send alerts to {chat_id} error: {error}')
+
+
+def update_rates():
+    rh = RatesHandler()
+    rates = rh.update_rates()
+    send_alerts(rh.alerts.pop_crossed(rates))
+
+
+def send_reminders(is_active=lambda: True):
+    # Scheduler job: remind about every due installment in batches, then sleep
+    # until the earliest pending reminder (or a while, to catch new records).
+    # `is_active` is checked before every batch, the jobs process stops sending
+    # as soon as it is no longer the leader.
+    with app.app_context():
+        while is_active():
+            rs = ReminderService()
+            reminders = rs.get_due_reminders()
+
+            if not reminders:
+                break
+
+            by_chat = defaultdict(list)
+
+            for reminder in reminders:
+                if reminder.tg_id:
+                    by_chat[reminder.tg_id].append(reminder)
+
+            for chat_id, items in by_chat.items():
+                lines = [f'{item.type.name.lower()} #{item.id} {item.name}: {item.payment_amount:g} '
+                         f'due {item.next_due_date.strftime("%d.%m.%Y")}, remains {item.remains:g}' for item in items]
+                try:
+                    send_message(chat_id, '<b>Payment reminders</b>\n' + '\n'.join(lines), parse_mode='HTML')
+                except Exception as error:
+                    app.logger.error(f'Send reminders to {chat_id} error: {error}')
+
+            rs.mark_sent([reminder.id for reminder in reminders])
+
+            # The send queue paces the batches, put() blocks while it is full
+            if len(reminders) < AppConfig.REMINDER_BATCH_SIZE:
+                break
+
+        remind_at = ReminderService().get_next_remind_at()
+
+    wake_at = time.time() + AppConfig.REMINDER_MAX_SLEEP
+
+    if remind_at is not None:
+        wake_at = min(wake_at, remind_at.replace(tzinfo=timezone.utc).timestamp())
+
+    return wake_at
 
 
 def request_city(message):
-    sent = bot.reply_to(message, 'Enter your city name:')
-    bot.register_next_step_handler(sent, get_locations)
+    reply_to(message, 'Enter your city name:')
+    bot.register_next_step_handler(message, get_locations)
 
 
 def get_locations(message):
     try:
         geo_data = WeatherService.get_geo_data(city_name=message.text)
     except WeatherServiceException as wse:
-        bot.send_message(message.chat.id, str(wse))
+        send_message(message.chat.id, str(wse))
     else:
         kb = types.InlineKeyboardMarkup(row_width=1)
 
         for item in geo_data:
             kb.add(types.InlineKeyboardButton(
                 text=f"{item.get('name')} - {item.get('admin1')} - {item.get('country_code')}",
-                callback_data=json.dumps({
-                    'type': 'weather',
-                    'lat': item.get('latitude'),
-                    'lon': item.get('longitude')
-                })
+                callback_data=encode_callback('weather', lat=item.get('latitude'), lon=item.get('longitude'))
             ))
 
-        bot.send_message(message.chat.id, 'Choose your city:', reply_markup=kb)
+        send_message(message.chat.id, 'Choose your city:', reply_markup=kb)
 
 
 def send_weather(chat_id, data):
     try:
         weather = WeatherService.get_current_weather_by_geo_data(**data)
     except WeatherServiceException as wse:
-        bot.send_message(chat_id, str(wse))
+        send_message(chat_id, str(wse))
     else:
         result_time = dt.strptime(weather.get("time"), "%Y-%m-%dT%H:%M").strftime("%d.%m.%Y %H:%M")
         result = (f'- Temperature: {weather.get("temperature")},\n'
@@ -81,11 +215,11 @@ def send_weather(chat_id, data):
                   f'- Is day: {"Yes" if weather.get("is_day") == 1 else "No"},\n'
                   f'- Time: {result_time}')
 
-        bot.send_message(chat_id, f'<b>Weather in your city:</b>\n{result}', parse_mode='HTML')
+        send_message(chat_id, f'<b>Weather in your city:</b>\n{result}', parse_mode='HTML')
 
 
 def set_record(message):
-    bot.send_message(message.chat.id, message.text)
+    send_message(message.chat.id, message.text)
 
 
 def create_record(message, record_type, title):
@@ -107,9 +241,9 @@ def create_record(message, record_type, title):
                 rs = RecordService(message.from_user)
                 rs.create_record(data)
             except RecordServiceException as rse:
-                bot.send_message(message.chat.id, str(rse))
+                send_message(message.chat.id, str(rse))
             else:
-                bot.send_message(message.chat.id, f'<b>Added new {title}</b>\n'
+                send_message(message.chat.id, f'<b>Added new {title}</b>\n'
                                                   f'name: {params[0]},\n'
                                                   f'amount: {params[1]},\n'
                                                   f'months: {params[2]},\n'
@@ -117,7 +251,7 @@ def create_record(message, record_type, title):
                                                   f'payment_day: {params[4]},\n'
                                                   f'last_date: {params[5]}', parse_mode='HTML')
     else:
-        bot.send_message(message.chat.id, 'You entered wrong params string.')
+        send_message(message.chat.id, 'You entered wrong params string.')
 
 
 def create_payment(message):
@@ -134,31 +268,31 @@ def create_payment(message):
                 ps = PaymentService(message.from_user)
                 ps.create_payment(data)
             except PaymentServiceException as pse:
-                bot.send_message(message.chat.id, str(pse))
+                send_message(message.chat.id, str(pse))
             else:
-                bot.send_message(message.chat.id, f'<b>Added new Payment</b>\n'
+                send_message(message.chat.id, f'<b>Added new Payment</b>\n'
                                                   f'record_id: {params[0]},\n'
                                                   f'amount: {params[1]},\n'
                                                   f'payment_date: {params[2]}', parse_mode='HTML')
     else:
-        bot.send_message(message.chat.id, 'You entered wrong params string.')
+        send_message(message.chat.id, 'You entered wrong params string.')
 
 
 def request_record(message, record_type):
-    sent = bot.reply_to(message, f'Type new {record_type} record data in format:\n'
-                                 f'<name>, <amount>, <months>, <payment_amount>, <payment_day>, <last_date>\n'
-                                 f'Example: Credit Card, 12000, 12, 1000, 25, 2024/08/25')
+    reply_to(message, f'Type new {record_type} record data in format:\n'
+                      f'<name>, <amount>, <months>, <payment_amount>, <payment_day>, <last_date>\n'
+                      f'Example: Credit Card, 12000, 12, 1000, 25, 2024/08/25')
     if record_type == 'lend':
-        bot.register_next_step_handler(sent, create_lend)
+        bot.register_next_step_handler(message, create_lend)
     else:
-        bot.register_next_step_handler(sent, create_borrow)
+        bot.register_next_step_handler(message, create_borrow)
 
 
 def request_payment(message):
-    sent = bot.reply_to(message, f'Type new payment data in format:\n'
-                                 f'<record_id>, <amount>, <payment_date>\n'
-                                 f'Example: 1, 1000, 2023/08/25')
-    bot.register_next_step_handler(sent, create_payment)
+    reply_to(message, f'Type new payment data in format:\n'
+                      f'<record_id>, <amount>, <payment_date>\n'
+                      f'Example: 1, 1000, 2023/08/25')
+    bot.register_next_step_handler(message, create_payment)
 
 
 def get_record(chat_id, from_user, data):
@@ -182,17 +316,14 @@ def get_record(chat_id, from_user, data):
 
             kb = types.InlineKeyboardMarkup(row_width=1)
             btn = types.InlineKeyboardButton(
-                text=f"🗑️ Delete",
-                callback_data=json.dumps({
-                    'type': 'record-delete',
-                    'id': record.id,
-                })
+                text="🗑️ Delete",
+                callback_data=encode_callback('record-delete', id=record.id)
             )
             kb.add(btn)
 
-            bot.send_message(chat_id, text, parse_mode='HTML', reply_markup=kb)
+            send_message(chat_id, text, parse_mode='HTML', reply_markup=kb)
         else:
-            bot.send_message(chat_id, 'Record not found')
+            send_message(chat_id, 'Record not found')
 
 
 def get_payment(chat_id, from_user, data):
@@ -212,17 +343,14 @@ def get_payment(chat_id, from_user, data):
 
             kb = types.InlineKeyboardMarkup(row_width=1)
             btn = types.InlineKeyboardButton(
-                text=f"🗑️ Delete",
-                callback_data=json.dumps({
-                    'type': 'payment-delete',
-                    'id': payment.id,
-                })
+                text="🗑️ Delete",
+                callback_data=encode_callback('payment-delete', id=payment.id)
             )
             kb.add(btn)
 
-            bot.send_message(chat_id, text, parse_mode='HTML', reply_markup=kb)
+            send_message(chat_id, text, parse_mode='HTML', reply_markup=kb)
         else:
-            bot.send_message(chat_id, 'Record not found')
+            send_message(chat_id, 'Record not found')
 
 
 def delete_record(chat_id, data):
@@ -232,7 +360,7 @@ def delete_record(chat_id, data):
             text = f'Record <b>#{data["id"]}</b> has been deleted'
         else:
             text = 'Record not found'
-        bot.send_message(chat_id, text, parse_mode='HTML')
+        send_message(chat_id, text, parse_mode='HTML')
 
 
 def delete_payment(chat_id, data):
@@ -242,7 +370,7 @@ def delete_payment(chat_id, data):
             text = f'Payment <b>#{data["id"]}</b> has been deleted'
         else:
             text = 'Payment not found'
-        bot.send_message(chat_id, text, parse_mode='HTML')
+        send_message(chat_id, text, parse_mode='HTML')
 
 
 def get_records_pt(records):
@@ -280,79 +408,145 @@ def get_payments_pt(payments):
     return pt
 
 
-def send_records(message, record_type, title):
+def get_page_buttons(pagination, callback_type, **fields):
+    buttons = []
+
+    if pagination.prev_cursor:
+        buttons.append(types.InlineKeyboardButton(
+            text='⬅️ Prev',
+            callback_data=encode_callback(callback_type, before=pagination.prev_cursor, **fields),
+        ))
+    if pagination.next_cursor:
+        buttons.append(types.InlineKeyboardButton(
+            text='Next ➡️',
+            callback_data=encode_callback(callback_type, after=pagination.next_cursor, **fields),
+        ))
+
+    return buttons
+
+
+def get_page_key(view, params):
+    return f'{view}:{params.get("after") or ""}:{params.get("before") or ""}'
+
+
+def get_records_page(from_user, record_type, params):
+    # Rendered pages are cached until the user's records or payments change
     with app.app_context():
-        rs = RecordService(message.from_user)
-        records = rs.get_records(record_type)
-        pt = get_records_pt(records)
+        rs = RecordService(from_user)
+        key = get_page_key(f'records:{record_type}', params)
+        return render_cache.get_or_set(rs.user_id, key, render_records_page, rs, record_type, params)
+
+
+def get_payments_page(from_user, params):
+    with app.app_context():
+        ps = PaymentService(from_user)
+        return render_cache.get_or_set(ps.user_id, get_page_key('payments', params), render_payments_page, ps, params)
 
-        bot.send_message(message.chat.id, f'<b>Your {title} list</b>\n{pt}', parse_mode='HTML')
 
-        kb = types.InlineKeyboardMarkup(row_width=2)
+def render_records_page(rs, record_type, params):
+    # One message per page: the table of the page plus its buttons
+    records, pagination = rs.get_records_page(record_type, params)
+    pt = get_records_pt(records)
+    title = TypeEnum(record_type).name.capitalize()
 
-        for item in records:
-            btn1 = types.InlineKeyboardButton(
-                text=f"📂 #{item.id} - {item.name}",
-                callback_data=json.dumps({
-                    'type': 'record-detail',
-                    'id': item.id,
-                }),
-            )
-            btn2 = types.InlineKeyboardButton(
-                text=f"🗑️ Delete",
-                callback_data=json.dumps({
-                    'type': 'record-delete',
-                    'id': item.id,
-                })
-            )
-            kb.add(btn1, btn2)
+    kb = types.InlineKeyboardMarkup(row_width=2)
+
+    for item in records:
+        btn1 = types.InlineKeyboardButton(
+            text=f"📂 #{item.id} - {item.name}",
+            callback_data=encode_callback('record-detail', id=item.id),
+        )
+        btn2 = types.InlineKeyboardButton(
+            text="🗑️ Delete",
+            callback_data=encode_callback('record-delete', id=item.id)
+        )
+        kb.add(btn1, btn2)
 
-        bot.send_message(message.chat.id, f'<b>{title} detail:</b>', parse_mode='HTML', reply_markup=kb)
+    if buttons := get_page_buttons(pagination, 'records', record_type=record_type):
+        kb.row(*buttons)
+
+    return f'<b>Your {title} list</b>\n{pt}', kb.to_dict()
+
+
+def render_payments_page(ps, params):
+    payments, pagination = ps.get_payments_page(params)
+    pt = get_payments_pt(payments)
+
+    kb = types.InlineKeyboardMarkup(row_width=3)
+
+    for item in payments:
+        btn1 = types.InlineKeyboardButton(
+            text=f"📂 #{item.id} - {item.record_id} - {item.amount}",
+            callback_data=encode_callback('payment-detail', id=item.id),
+        )
+        btn2 = types.InlineKeyboardButton(
+            text="🗑️ Delete",
+            callback_data=encode_callback('payment-delete', id=item.id)
+        )
+        btn3 = types.InlineKeyboardButton(
+            text=f"📂 Record #{item.record_id}",
+            callback_data=encode_callback('record-detail', id=item.record_id),
+        )
+        kb.add(btn1, btn2, btn3)
+
+    if buttons := get_page_buttons(pagination, 'payments'):
+        kb.row(*buttons)
+
+    return f'<b>Your Payment list</b>\n{pt}', kb.to_dict()
+
+
+def send_records(message, record_type):
+    text, kb = get_records_page(message.from_user, record_type, {})
+    send_message(message.chat.id, text, parse_mode='HTML', reply_markup=kb)
 
 
 def send_payments(message):
+    text, kb = get_payments_page(message.from_user, {})
+    send_message(message.chat.id, text, parse_mode='HTML', reply_markup=kb)
+
+
+def edit_records(callback, data):
+    text, kb = get_records_page(callback.from_user, data.pop('record_type'), data)
+    edit_message(callback.message, text, parse_mode='HTML', reply_markup=kb)
+
+
+def edit_payments(callback, data):
+    text, kb = get_payments_page(callback.from_user, data)
+    edit_message(callback.message, text, parse_mode='HTML', reply_markup=kb)
+
+
+def send_forecast(message):
     with app.app_context():
-        ps = PaymentService(message.from_user)
-        payments = ps.get_payments()
-        pt = get_payments_pt(payments)
+        rs = RecordService(message.from_user)
 
-        bot.send_message(message.chat.id, f'<b>Your Payment list</b>\n{pt}', parse_mode='HTML')
+        try:
+            portfolio = ForecastService(rs.user_id).get_portfolio()
+        except ForecastServiceException as fse:
+            send_message(message.chat.id, str(fse))
+            return
 
-        kb = types.InlineKeyboardMarkup(row_width=3)
+        pt = PrettyTable()
+        pt.field_names = ['month', 'incoming', 'outgoing']
 
-        for item in payments:
-            btn1 = types.InlineKeyboardButton(
-                text=f"📂 #{item.id} - {item.record_id} - {item.amount}",
-                callback_data=json.dumps({
-                    'type': 'payment-detail',
-                    'id': item.id,
-                }),
-            )
-            btn2 = types.InlineKeyboardButton(
-                text=f"🗑️ Delete",
-                callback_data=json.dumps({
-                    'type': 'payment-delete',
-                    'id': item.id,
-                })
-            )
-            btn3 = types.InlineKeyboardButton(
-                text=f"📂 Record #{item.record_id}",
-                callback_data=json.dumps({
-                    'type': 'record-detail',
-                    'id': item.record_id,
-                }),
-            )
-            kb.add(btn1, btn2, btn3)
+        for month, incoming, outgoing in portfolio['forecast']:
+            pt.add_row([month.strftime('%m.%Y'), round(incoming, 2), round(outgoing, 2)])
+
+        overdue = '\n'.join(f'#{record_id} {name}: {arrears:g}' for record_id, name, arrears in portfolio['overdue'])
 
-        bot.send_message(message.chat.id, f'<b>Payment detail:</b>', parse_mode='HTML', reply_markup=kb)
+        send_message(message.chat.id, f'<b>Your forecast on {portfolio["as_of"].strftime("%d.%m.%Y")}</b>\n'
+                                          f'Lends outstanding: {portfolio["lends_outstanding"]:g}\n'
+                                          f'Borrows outstanding: {portfolio["borrows_outstanding"]:g}\n'
+                                          f'Lends in arrears: {portfolio["lends_arrears"]:g}\n'
+                                          f'Borrows in arrears: {portfolio["borrows_arrears"]:g}\n'
+                                          f'{overdue}\n<pre>{pt}</pre>', parse_mode='HTML')
 
 
 def send_lends(message):
-    send_records(message, 1, 'Lend')
+    send_records(message, 1)
 
 
 def send_borrows(message):
-    send_records(message, 2, 'Borrow')
+    send_records(message, 2)
 
 
 def create_lend(message):
@@ -371,35 +565,57 @@ def request_payment_id(message):
     get_payment(message.chat.id, message.from_user, {'id': message.text})
 
 
-@bot.callback_query_handler(func=lambda callback: callback.data)
-def check_callback_data(callback):
-    if chat_id := callback.message.chat.id:
-        callback_data = json.loads(callback.data)
-
-        callback_type = callback_data.pop('type')
-        match callback_type:
-            case 'weather':
-                send_weather(chat_id, callback_data)
-            case 'lend' | 'borrow':
-                request_record(callback.message, callback_type)
-            case 'record-detail':
-                get_record(chat_id, callback.from_user, callback_data)
-            case 'record-delete':
-                delete_record(chat_id, callback_data)
-            case 'payment-detail':
-                get_payment(chat_id, callback.from_user, callback_data)
-            case 'payment-delete':
-                delete_payment(chat_id, callback_data)
-            case _:
-                bot.send_message(chat_id, 'Unknown callback')
-
-
-@bot.message_handler(commands=["help"])
+@dispatcher.callback('weather')
+def cb_weather(callback, data):
+    send_weather(callback.message.chat.id, data)
+
+
+@dispatcher.callback('lend')
+def cb_lend(callback, data):
+    request_record(callback.message, 'lend')
+
+
+@dispatcher.callback('borrow')
+def cb_borrow(callback, data):
+    request_record(callback.message, 'borrow')
+
+
+@dispatcher.callback('record-detail')
+def cb_record_detail(callback, data):
+    get_record(callback.message.chat.id, callback.from_user, data)
+
+
+@dispatcher.callback('record-delete')
+def cb_record_delete(callback, data):
+    delete_record(callback.message.chat.id, data)
+
+
+@dispatcher.callback('payment-detail')
+def cb_payment_detail(callback, data):
+    get_payment(callback.message.chat.id, callback.from_user, data)
+
+
+@dispatcher.callback('payment-delete')
+def cb_payment_delete(callback, data):
+    delete_payment(callback.message.chat.id, data)
+
+
+@dispatcher.callback('records')
+def cb_records(callback, data):
+    edit_records(callback, data)
+
+
+@dispatcher.callback('payments')
+def cb_payments(callback, data):
+    edit_payments(callback, data)
+
+
+@dispatcher.command('help')
 def cmd_help(message):
-    bot.send_message(message.chat.id, commands, parse_mode='HTML')
+    send_message(message.chat.id, commands, parse_mode='HTML')
 
 
-@bot.message_handler(commands=["start"])
+@dispatcher.command('start')
 def cmd_start(message):
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=3)
 
@@ -417,90 +633,111 @@ def cmd_start(message):
     kb.add(btn6, btn7, btn8)
 
     user = create_user(message.from_user)
-    bot.send_message(message.chat.id, 'Select what you want in menu', reply_markup=kb)
+    send_message(message.chat.id, 'Select what you want in menu', reply_markup=kb)
 
 
-@bot.message_handler(commands=["rates"])
+@dispatcher.command('rates')
+@dispatcher.text('💵 Rates')
 def cmd_rates(message):
     send_rates(message)
 
 
-@bot.message_handler(commands=["weather"])
+@dispatcher.command('alert')
+def cmd_alert(message):
+    subscribe_alert(message)
+
+
+@dispatcher.command('weather')
+@dispatcher.text('🌤 Weather')
 def cmd_weather(message):
     request_city(message)
 
 
-@bot.message_handler(commands=["lends"])
+@dispatcher.command('lends')
+@dispatcher.text('💸 Lends')
 def cmd_lends(message):
     send_lends(message)
 
 
-@bot.message_handler(commands=["borrows"])
+@dispatcher.command('borrows')
+@dispatcher.text('💰 Borrows')
 def cmd_borrows(message):
     send_borrows(message)
 
 
-@bot.message_handler(commands=["payments"])
+@dispatcher.command('payments')
+@dispatcher.text('✅ Payments')
 def cmd_payments(message):
     send_payments(message)
 
 
-@bot.message_handler(commands=["record"])
+@dispatcher.command('record')
 def cmd_record(message):
-    sent = bot.reply_to(message, 'Enter record id:')
-    bot.register_next_step_handler(sent, request_record_id)
+    reply_to(message, 'Enter record id:')
+    bot.register_next_step_handler(message, request_record_id)
 
 
-@bot.message_handler(commands=["payment"])
+@dispatcher.command('payment')
 def cmd_payment(message):
-    sent = bot.reply_to(message, 'Enter payment id:')
-    bot.register_next_step_handler(sent, request_payment_id)
+    reply_to(message, 'Enter payment id:')
+    bot.register_next_step_handler(message, request_payment_id)
+
+
+@dispatcher.command('forecast')
+def cmd_forecast(message):
+    send_forecast(message)
 
 
-@bot.message_handler(commands=["add"])
+@dispatcher.command('add')
 def cmd_add(message):
     kb = types.InlineKeyboardMarkup(row_width=2)
 
     btn1 = types.InlineKeyboardButton(
         text="Lend",
-        callback_data=json.dumps({'type': 'lend'})
+        callback_data=encode_callback('lend')
     )
     btn2 = types.InlineKeyboardButton(
         text="Borrow",
-        callback_data=json.dumps({'type': 'borrow'})
+        callback_data=encode_callback('borrow')
     )
     kb.add(btn1, btn2)
 
-    bot.send_message(message.chat.id, 'Choose record type:', reply_markup=kb)
+    send_message(message.chat.id, 'Choose record type:', reply_markup=kb)
+
+
+@dispatcher.text('＋ Lend')
+def cmd_add_lend(message):
+    request_record(message, 'lend')
+
 
+@dispatcher.text('＋ Borrow')
+def cmd_add_borrow(message):
+    request_record(message, 'borrow')
 
-@bot.message_handler(commands=["pay"])
+
+@dispatcher.command('pay')
+@dispatcher.text('＋ Payment')
 def cmd_pay(message):
     request_payment(message)
 
 
+# Single entry points for telebot, the dispatcher routes with a dict lookup
+# instead of telebot testing every handler's filters in turn
+@bot.callback_query_handler(func=lambda callback: callback.data)
+def check_callback_data(callback):
+    if chat_id := callback.message.chat.id:
+        try:
+            callback_type, callback_data = decode_callback(callback.data)
+        except CallbackDataException as cde:
+            app.logger.warning(str(cde))
+            callback_type, callback_data = None, {}
+
+        if not dispatcher.dispatch_callback(callback_type, callback, callback_data):
+            send_message(chat_id, 'Unknown callback')
+
+
 @bot.message_handler(content_types=["text"])
 def message_handler(message):
-    text = message.text
-    # print('TEXT:', text)
-
-    match text:
-        case '💵 Rates':
-            send_rates(message)
-        case '🌤 Weather':
-            request_city(message)
-        case '💸 Lends':
-            send_lends(message)
-        case '💰 Borrows':
-            send_borrows(message)
-        case '✅ Payments':
-            send_payments(message)
-        case '＋ Lend':
-            request_record(message, 'lend')
-        case '＋ Borrow':
-            request_record(message, 'borrow')
-        case '＋ Payment':
-            request_payment(message)
-        case _:
-            text = "I don't know what you want.\nTry some available command.\nSend /help for details."
-            bot.send_message(message.chat.id, text)
+    if not dispatcher.dispatch_message(message.text, message):
+        text = "I don't know what you want.\nTry some available command.\nSend /help for details."
+        send_message(message.chat.id, text)
@@ -0,0 +1,255 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from redis import RedisError
+
+from metrics import CounterSnapshot, collector
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+caches = {}
+
+
+class TTLCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+
+        if item is None or item[1] <= time.monotonic():
+            return default
+
+        return item[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class LRUCache(TTLCache):
+    def __init__(self, maxsize, ttl):
+        super().__init__(ttl)
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+
+            if item is None:
+                return default
+
+            if item[1] <= time.monotonic():
+                del self.data[key]
+                return default
+
+            self.data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + ttl)
+            self.data.move_to_end(key)
+
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+# In-process LRU in front of Redis. Values are stored as JSON, so None is a
+# valid cached value (e.g. a negative result) and MISSING marks a miss.
+class TwoTierCache:
+    def __init__(self, name, maxsize, ttl, local_ttl=None):
+        self.name = name
+        self.ttl = ttl
+        self.local_ttl = min(ttl, local_ttl or ttl)
+        self.local = LRUCache(maxsize, self.local_ttl)
+        self.stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0}
+        caches[name] = self
+
+    def get_key(self, key):
+        return f'cache:{self.name}:{key}'
+
+    def get(self, key):
+        value = self.local.get(key, MISSING)
+
+        if value is not MISSING:
+            self.stats['local_hits'] += 1
+            return value
+
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            pipe.get(self.get_key(key))
+            pipe.ttl(self.get_key(key))
+            raw, ttl = pipe.execute()
+        except RedisError as error:
+            logger.warning(f'Cache {self.name} read error: {error}')
+            raw = None
+
+        if raw is None:
+            self.stats['misses'] += 1
+            return MISSING
+
+        value = json.loads(raw)
+        self.local.set(key, value, min(ttl, self.local_ttl) if ttl > 0 else self.local_ttl)
+        self.stats['redis_hits'] += 1
+
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.local.set(key, value, min(ttl, self.local_ttl))
+
+        try:
+            get_redis().set(self.get_key(key), json.dumps(value), ex=int(ttl))
+        except RedisError as error:
+            logger.warning(f'Cache {self.name} write error: {error}')
+
+    def delete(self, key):
+        self.local.delete(key)
+
+        try:
+            get_redis().delete(self.get_key(key))
+        except RedisError as error:
+            logger.warning(f'Cache {self.name} delete error: {error}')
+
+    def get_stats(self):
+        return {**self.stats, 'local_size': len(self.local.data)}
+
+
+# Concurrent calls for the same key share the result of the first one
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self.calls[key] = Future()
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as error:
+            call.set_exception(error)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+# Entries of one owner are kept in a Redis hash and tagged with the owner's
+# data version. A read is one round trip for the version and the entry, an
+# entry rendered from older data no longer matches and counts as a miss.
+class VersionedCache:
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0, 'bumps': 0}
+        caches[name] = self
+
+    def get_key(self, owner):
+        return f'cache:{self.name}:{owner}'
+
+    def get_version_key(self, owner):
+        return f'cache:{self.name}:{owner}:version'
+
+    def get(self, owner, key):
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            pipe.get(self.get_version_key(owner))
+            pipe.hget(self.get_key(owner), key)
+            version, raw = pipe.execute()
+        except RedisError as error:
+            logger.warning(f'Cache {self.name} read error: {error}')
+            return MISSING, None
+
+        version = int(version or 0)
+
+        if raw is not None:
+            entry = json.loads(raw)
+
+            if entry['version'] == version:
+                self.stats['hits'] += 1
+                return entry['value'], version
+
+        self.stats['misses'] += 1
+        return MISSING, version
+
+    def set(self, owner, key, version, value):
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            pipe.hset(self.get_key(owner), key, json.dumps({'version': version, 'value': value}))
+            pipe.expire(self.get_key(owner), self.ttl)
+            pipe.execute()
+        except RedisError as error:
+            logger.warning(f'Cache {self.name} write error: {error}')
+
+    def get_or_set(self, owner, key, fn, *args):
+        # The version is read before rendering, so a render racing with a bump
+        # is stored under the old version and never served
+        value, version = self.get(owner, key)
+
+        if value is MISSING:
+            value = fn(*args)
+
+            if version is not None:
+                self.set(owner, key, version, value)
+
+        return value
+
+    def bump(self, owner):
+        try:
+            pipe = get_redis().pipeline()
+            pipe.incr(self.get_version_key(owner))
+            pipe.expire(self.get_version_key(owner), self.ttl)
+            pipe.delete(self.get_key(owner))
+            pipe.execute()
+            self.stats['bumps'] += 1
+        except RedisError as error:
+            logger.warning(f'Cache {self.name} bump error: {error}')
+
+    def get_stats(self):
+        return dict(self.stats)
+
+
+@collector
+def collect_caches():
+    events = CounterSnapshot('cache_events_total', 'Cache hits, misses and invalidations', ('cache', 'event'))
+
+    for name, cache in caches.items():
+        for event, value in cache.get_stats().items():
+            if event != 'local_size':
+                events.set(value, name, event)
+
+    return [events]
@@ -0,0 +1,119 @@
+import json
+from functools import partial
+
+VERSION = '1'
+SEPARATOR = ':'
+MAX_LENGTH = 64
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+class CallbackDataException(Exception):
+    pass
+
+
+def to_base36(value):
+    sign, value = ('-', -value) if value < 0 else ('', value)
+    digits = ''
+
+    while True:
+        value, digit = divmod(value, 36)
+        digits = DIGITS[digit] + digits
+
+        if not value:
+            return sign + digits
+
+
+class Int:
+    decode = staticmethod(partial(int, base=36))
+
+    @staticmethod
+    def encode(value):
+        return to_base36(int(value))
+
+
+class Fixed:
+    def __init__(self, scale):
+        self.scale = scale
+
+    def encode(self, value):
+        return to_base36(round(float(value) * self.scale))
+
+    def decode(self, raw):
+        return int(raw, 36) / self.scale
+
+
+class Optional:
+    def __init__(self, field):
+        self.field = field
+
+    def encode(self, value):
+        return '' if value is None else self.field.encode(value)
+
+    def decode(self, raw):
+        return self.field.decode(raw) if raw else None
+
+
+INT = Int()
+OPTIONAL_INT = Optional(INT)
+COORDINATE = Fixed(10 ** 4)
+
+# type: (tag, fields). Tags and field order are part of the wire format: add
+# new types freely, but changing an existing one needs a new VERSION.
+SCHEMAS = {
+    'weather': ('w', (('lat', COORDINATE), ('lon', COORDINATE))),
+    'lend': ('l', ()),
+    'borrow': ('b', ()),
+    'record-detail': ('r', (('id', INT),)),
+    'record-delete': ('rx', (('id', INT),)),
+    'payment-detail': ('p', (('id', INT),)),
+    'payment-delete': ('px', (('id', INT),)),
+    'records': ('rs', (('record_type', INT), ('after', OPTIONAL_INT), ('before', OPTIONAL_INT))),
+    'payments': ('ps', (('after', OPTIONAL_INT), ('before', OPTIONAL_INT))),
+}
+
+# Decoding side, keyed by the version and tag prefix so one dict lookup finds
+# the field names and their bound decoders
+TYPES = {
+    VERSION + tag: (callback_type, tuple(name for name, _ in fields), tuple(field.decode for _, field in fields))
+    for callback_type, (tag, fields) in SCHEMAS.items()
+}
+
+
+# Callback data is "<version><tag>:<field>:<field>" with integers in base 36 and
+# coordinates as fixed point, e.g. "1w:2d9p:-1b7k" instead of 50+ bytes of JSON
+def encode_callback(callback_type, **values):
+    try:
+        tag, fields = SCHEMAS[callback_type]
+        data = SEPARATOR.join((VERSION + tag, *(field.encode(values.get(name)) for name, field in fields)))
+    except (KeyError, TypeError, ValueError) as error:
+        raise CallbackDataException(f'Can not encode {callback_type} callback: {error}')
+
+    if len(data.encode()) > MAX_LENGTH:
+        raise CallbackDataException(f'Callback data is longer than {MAX_LENGTH} bytes: {data}')
+
+    return data.rstrip(SEPARATOR)
+
+
+def decode_callback(data):
+    # Buttons sent before the codec still carry JSON
+    if data.startswith('{'):
+        try:
+            values = json.loads(data)
+            return values.pop('type'), values
+        except (ValueError, KeyError, AttributeError) as error:
+            raise CallbackDataException(f'Invalid callback data: {error}')
+
+    prefix, *raw = data.split(SEPARATOR)
+
+    try:
+        callback_type, names, decoders = TYPES[prefix]
+    except KeyError:
+        raise CallbackDataException(f'Unknown callback data: {data}')
+
+    if len(raw) < len(names):
+        raw += [''] * (len(names) - len(raw))
+
+    try:
+        return callback_type, {name: decoder(value) for name, decoder, value in zip(names, decoders, raw)}
+    except ValueError as error:
+        raise CallbackDataException(f'Invalid callback data: {error}')
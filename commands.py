@@ -0,0 +1,77 @@
+import json
+import sys
+
+import click
+
+from app import app, db
+from benchmark import compare_reports, run_benchmark, write_report
+from datagen import generate_data
+from migrations import check_query_plans, get_pending_migrations, migrate, rebuild_balances, rebuild_due_dates
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations."""
+    migrate(log=click.echo)
+    click.echo('Schema is up to date')
+
+
+@app.cli.command('check-indexes')
+def check_indexes():
+    """Fail if a hot services.py query falls back to a sequential scan."""
+    if pending := get_pending_migrations():
+        click.echo(f'Pending migrations: {", ".join(name for _, name in pending)}')
+        sys.exit(1)
+
+    problems = check_query_plans()
+
+    for name, scans in problems.items():
+        click.echo(f'Sequential scan in "{name}": {", ".join(scans)}')
+
+    if problems:
+        sys.exit(1)
+
+    click.echo('All hot queries use an index')
+
+
+@app.cli.command('repair-balances')
+def repair_balances():
+    """Rebuild Record.paid_total, Record.remains and Record.next_due_date from payment history."""
+    with db.engine.begin() as connection:
+        count = rebuild_balances(connection)
+        rebuild_due_dates(connection)
+
+    click.echo(f'Repaired {count} records')
+
+
+@app.cli.command('generate-data')
+@click.option('--users', default=1000, show_default=True, help='Users to add.')
+@click.option('--records', default=5.0, show_default=True, help='Mean records per user.')
+@click.option('--payments', default=4.0, show_default=True, help='Mean paid installments per record.')
+@click.option('--seed', default=1, show_default=True, help='Random seed.')
+@click.confirmation_option(prompt='Add synthetic users, records and payments to the configured database?')
+def generate_data_command(users, records, payments, seed):
+    """Fill User, Record and Payment with synthetic data using bulk inserts."""
+    with db.engine.connect() as connection:
+        totals = generate_data(connection, users, records, payments, seed=seed, log=click.echo)
+
+    click.echo(f'Added {totals["users"]} users, {totals["records"]} records and {totals["payments"]} payments')
+
+
+@app.cli.command('benchmark')
+@click.option('--scales', default='1000,10000,100000', show_default=True, help='Comma separated user counts.')
+@click.option('--repeat', default=20, show_default=True, help='Timed calls per case and scale.')
+@click.option('--records', default=5.0, show_default=True, help='Mean records per generated user.')
+@click.option('--payments', default=4.0, show_default=True, help='Mean paid installments per generated record.')
+@click.option('--report', default='benchmark.json', show_default=True, type=click.Path(dir_okay=False))
+@click.option('--compare', default=None, type=click.File(), help='Earlier report to compare against.')
+@click.confirmation_option(prompt='Grow the configured database with synthetic data up to every scale?')
+def benchmark_command(scales, repeat, records, payments, report, compare):
+    """Time admin views and service methods at several data scales."""
+    result = run_benchmark([int(scale) for scale in scales.split(',')], repeat, records, payments, log=click.echo)
+    write_report(result, report)
+    click.echo(f'Report written to {report}')
+
+    if compare:
+        for line in compare_reports(result, json.load(compare)):
+            click.echo(line)
@@ -9,12 +9,61 @@ class AppConfig:
     DEBUG = os.getenv('DEBUG')
     HOST = os.getenv('HOST')
     PORT = os.getenv('PORT')
+    WEB_WORKERS = int(os.getenv('WEB_WORKERS', (os.cpu_count() or 1) + 1))
+    WEB_THREADS = int(os.getenv('WEB_THREADS', 4))
+    WEB_TIMEOUT = int(os.getenv('WEB_TIMEOUT', 30))
+    JOBS_LOCK_TTL = int(os.getenv('JOBS_LOCK_TTL', 30))
     APP_URL = os.getenv('APP_URL')
     SERVER_URL = os.getenv('SERVER_URL')
     REDIS_HOST = os.getenv('REDIS_HOST')
     REDIS_PORT = os.getenv('REDIS_PORT')
+    REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
     SECRET_KEY = os.getenv('SECRET_KEY')
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URI')
     TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
     TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-    TELEGRAM_URL = f'https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/'
+    TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+    TELEGRAM_URL = f'{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/'
+    BINANCE_API_URL = os.getenv('BINANCE_API_URL', 'https://api.binance.com')
+    OPEN_METEO_API_URL = os.getenv('OPEN_METEO_API_URL', 'https://api.open-meteo.com')
+    OPEN_METEO_GEO_URL = os.getenv('OPEN_METEO_GEO_URL', 'https://geocoding-api.open-meteo.com')
+    CURRENCY_PAIRS = tuple(pair.strip().upper() for pair in os.getenv('CURRENCY_PAIRS', 'BTCUSDT,ETHUSDT').split(',') if pair.strip())
+    RATES_UPDATE_INTERVAL = int(os.getenv('RATES_UPDATE_INTERVAL', 3600))
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 24 * 60 * 60))
+    USER_CACHE_LOCAL_TTL = int(os.getenv('USER_CACHE_LOCAL_TTL', 5 * 60))
+    GEO_CACHE_SIZE = int(os.getenv('GEO_CACHE_SIZE', 1000))
+    GEO_CACHE_TTL = int(os.getenv('GEO_CACHE_TTL', 30 * 24 * 60 * 60))
+    GEO_NEGATIVE_CACHE_TTL = int(os.getenv('GEO_NEGATIVE_CACHE_TTL', 10 * 60))
+    WEATHER_CACHE_SIZE = int(os.getenv('WEATHER_CACHE_SIZE', 1000))
+    WEATHER_CACHE_TTL = int(os.getenv('WEATHER_CACHE_TTL', 15 * 60))
+    WEATHER_GRID = float(os.getenv('WEATHER_GRID', 0.1))
+    RENDER_CACHE_TTL = int(os.getenv('RENDER_CACHE_TTL', 60 * 60))
+    PORTFOLIO_CACHE_TTL = int(os.getenv('PORTFOLIO_CACHE_TTL', 24 * 60 * 60))
+    PAGE_SIZE = int(os.getenv('PAGE_SIZE', 20))
+    MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 100))
+    BOT_PAGE_SIZE = int(os.getenv('BOT_PAGE_SIZE', 10))
+    OPTIONS_LIMIT = int(os.getenv('OPTIONS_LIMIT', 20))
+    WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+    WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 100))
+    UPDATE_ORDER_TIMEOUT = float(os.getenv('UPDATE_ORDER_TIMEOUT', 30))
+    HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3.05))
+    HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 10))
+    HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 3))
+    HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', 0.3))
+    HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 10))
+    HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+    SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))
+    SEND_QUEUE_SIZE = int(os.getenv('SEND_QUEUE_SIZE', 1000))
+    SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))
+    SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+    SEND_CHAT_BURST = float(os.getenv('SEND_CHAT_BURST', 3))
+    SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 3))
+    SEND_DRAIN_TIMEOUT = float(os.getenv('SEND_DRAIN_TIMEOUT', 20))
+    REMINDER_HOUR = int(os.getenv('REMINDER_HOUR', 9))
+    REMINDER_DAYS_BEFORE = int(os.getenv('REMINDER_DAYS_BEFORE', 1))
+    REMINDER_BATCH_SIZE = int(os.getenv('REMINDER_BATCH_SIZE', 25))
+    REMINDER_MAX_SLEEP = int(os.getenv('REMINDER_MAX_SLEEP', 60 * 60))
+    QUERY_DEBUG = os.getenv('QUERY_DEBUG')
+    QUERY_REPEAT_LIMIT = int(os.getenv('QUERY_REPEAT_LIMIT', 5))
+    SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 100))
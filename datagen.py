@@ -0,0 +1,158 @@
+from datetime import datetime
+
+import numpy as np
+
+from app import db
+from migrations import rebuild_due_dates
+from models import User, Record, Payment, TypeEnum
+from services import portfolio_cache
+
+FIRST_NAMES = ('Olena', 'Andrii', 'Iryna', 'Taras', 'Maria', 'Dmytro', 'Sofiia', 'Oleh', 'Anna', 'Serhii')
+LAST_NAMES = ('Shevchenko', 'Kovalenko', 'Bondarenko', 'Tkachenko', 'Kravchenko', 'Melnyk', 'Boiko', 'Moroz')
+LANGUAGES = ('uk', 'en', 'pl', 'de')
+RECORD_NAMES = ('Car', 'Flat repair', 'Laptop', 'Phone', 'Vacation', 'Tuition', 'Furniture', 'Bike')
+MONTHS = np.array([3, 6, 12, 24, 36])
+DAY = np.timedelta64(1, 'D')
+MONTH = np.timedelta64(30, 'D')
+
+
+def get_next_id(connection, model):
+    return (connection.execute(db.select(db.func.max(model.id))).scalar() or 0) + 1
+
+
+def to_datetimes(values):
+    return values.astype('datetime64[us]').tolist()
+
+
+def insert(connection, model, columns, insert_size):
+    keys = list(columns)
+    rows = [dict(zip(keys, values)) for values in zip(*columns.values())]
+
+    for start in range(0, len(rows), insert_size):
+        connection.execute(model.__table__.insert(), rows[start:start + insert_size])
+
+
+def reset_sequences(connection):
+    # Ids are assigned here, so Postgres sequences have to catch up
+    if connection.dialect.name != 'postgresql':
+        return
+
+    for model in (User, Record, Payment):
+        table = connection.dialect.identifier_preparer.format_table(model.__table__)
+        connection.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"
+        ))
+
+
+def generate_users(rng, connection, count, records, now, insert_size):
+    first_id = get_next_id(connection, User)
+    ids = np.arange(first_id, first_id + count)
+    # Most users keep one or two records, a few run dozens
+    counts = np.minimum(rng.geometric(1 / (records + 1), count) - 1, 200)
+    created_at = now - (rng.uniform(30, 3 * 365, count) * 86400).astype('timedelta64[s]')
+
+    insert(connection, User, {
+        'id': ids.tolist(),
+        'username': [f'user{user_id}' for user_id in ids],
+        'tg_id': [str(10 ** 9 + user_id) for user_id in ids],
+        'is_bot': [False] * count,
+        'language_code': rng.choice(LANGUAGES, count).tolist(),
+        'first_name': rng.choice(FIRST_NAMES, count).tolist(),
+        'last_name': rng.choice(LAST_NAMES, count).tolist(),
+        'created_at': to_datetimes(created_at),
+        'updated_at': to_datetimes(created_at),
+    }, insert_size)
+
+    return ids, counts, created_at
+
+
+def generate_records(rng, connection, user_ids, counts, user_created_at, payments, now, insert_size):
+    count = int(counts.sum())
+    first_id = get_next_id(connection, Record)
+    ids = np.arange(first_id, first_id + count)
+    owners = np.repeat(user_ids, counts)
+    months = rng.choice(MONTHS, count)
+    amount = np.round(rng.lognormal(np.log(1000), 1, count), -1) + 10
+    payment_amount = np.round(amount / months, 2)
+    # Paid installments: on schedule for most records, some fall behind
+    paid = np.minimum(rng.poisson(payments, count), months)
+    behind = np.where(rng.random(count) < 0.1, rng.integers(1, 4, count), 0)
+    started_at = np.maximum(now - (paid + behind) * MONTH - rng.integers(0, 30, count) * DAY,
+                            np.repeat(user_created_at, counts))
+    # Records of recent users can not have paid more than has passed since
+    paid = np.minimum(paid, (now - started_at) // MONTH)
+    paid_total = np.round(paid * payment_amount, 2)
+
+    insert(connection, Record, {
+        'id': ids.tolist(),
+        'user_id': owners.tolist(),
+        'type': [TypeEnum.LEND if lend else TypeEnum.BORROW for lend in rng.random(count) < 0.5],
+        'name': rng.choice(RECORD_NAMES, count).tolist(),
+        'amount': amount.tolist(),
+        'remains': np.round(amount - paid_total, 2).tolist(),
+        'paid_total': paid_total.tolist(),
+        'months': months.tolist(),
+        'payment_amount': payment_amount.tolist(),
+        'payment_day': rng.integers(1, 29, count).tolist(),
+        'last_date': to_datetimes(started_at + months * MONTH),
+        'reminder_sent': [False] * count,
+        'created_at': to_datetimes(started_at),
+        'updated_at': to_datetimes(started_at),
+    }, insert_size)
+
+    return ids, owners, paid, amount, payment_amount, started_at
+
+
+def generate_payments(connection, record_ids, owners, paid, amount, payment_amount, started_at, insert_size):
+    count = int(paid.sum())
+    first_id = get_next_id(connection, Payment)
+    # Installment number of every payment within its record: 1, 2, ..., paid
+    number = np.arange(count) - np.repeat(np.cumsum(paid) - paid, paid) + 1
+    payment_date = np.repeat(started_at, paid) + number * MONTH
+
+    insert(connection, Payment, {
+        'id': list(range(first_id, first_id + count)),
+        'user_id': np.repeat(owners, paid).tolist(),
+        'record_id': np.repeat(record_ids, paid).tolist(),
+        'amount': np.repeat(payment_amount, paid).tolist(),
+        'remains': np.round(np.repeat(amount, paid) - number * np.repeat(payment_amount, paid), 2).tolist(),
+        'payment_date': to_datetimes(payment_date),
+        'created_at': to_datetimes(payment_date),
+        'updated_at': to_datetimes(payment_date),
+    }, insert_size)
+
+    return count
+
+
+# Users are generated in batches of `batch_size`, each batch inserted and
+# committed with executemany before the next one is built, so memory stays flat
+# however many payments are asked for. `records` is the mean number of records
+# per user, `payments` the mean number of installments already paid per record.
+def generate_data(connection, users, records=5.0, payments=4.0, batch_size=10000, insert_size=5000, seed=1,
+                  log=print):
+    rng = np.random.default_rng(seed)
+    now = np.datetime64(datetime.utcnow().replace(microsecond=0), 's')
+    first_record_id = get_next_id(connection, Record)
+    totals = {'users': 0, 'records': 0, 'payments': 0}
+
+    for start in range(0, users, batch_size):
+        user_ids, counts, created_at = generate_users(
+            rng, connection, min(batch_size, users - start), records, now, insert_size)
+        record_ids, owners, paid, amount, payment_amount, started_at = generate_records(
+            rng, connection, user_ids, counts, created_at, payments, now, insert_size)
+        payment_count = generate_payments(
+            connection, record_ids, owners, paid, amount, payment_amount, started_at, insert_size)
+        connection.commit()
+
+        totals['users'] += len(user_ids)
+        totals['records'] += len(record_ids)
+        totals['payments'] += payment_count
+        log(f'{totals["users"]} users, {totals["records"]} records, {totals["payments"]} payments')
+
+    reset_sequences(connection)
+    rebuild_due_dates(connection, after_id=first_record_id - 1)
+    connection.commit()
+    # Rows are inserted past the session, whose commit hook would mark their users
+    portfolio_cache.reset()
+
+    return totals
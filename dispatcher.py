@@ -0,0 +1,95 @@
+import time
+
+from metrics import CallStats, Counter, Histogram
+
+dispatchers = {}
+
+HANDLER_DURATION = Histogram('bot_handler_duration_seconds', 'Bot command, keyboard and callback handler latency',
+                             ('bot', 'handler'))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Bot handlers that raised', ('bot', 'handler'))
+
+
+class DispatcherException(Exception):
+    pass
+
+
+# Routes of one bot: commands, reply keyboard texts and callback types, each
+# resolved with a single dict lookup. Handlers are registered with decorators
+# and returned unchanged, so methods can be registered in a class body too.
+class Dispatcher:
+    def __init__(self, name):
+        self.name = name
+        self.routes = {'command': {}, 'text': {}, 'callback': {}}
+        self.stats = CallStats()
+        dispatchers[name] = self
+
+    def register(self, kind, *keys):
+        def decorator(handler):
+            for key in keys:
+                if key in self.routes[kind]:
+                    raise DispatcherException(f'{self.name}: {kind} "{key}" is already routed')
+                self.routes[kind][key] = handler
+
+            return handler
+
+        return decorator
+
+    def command(self, *names):
+        return self.register('command', *names)
+
+    def text(self, *texts):
+        return self.register('text', *texts)
+
+    def callback(self, *callback_types):
+        return self.register('callback', *callback_types)
+
+    @staticmethod
+    def get_command(text):
+        # "/alert@SomeBot BTCUSDT above 70000" -> "alert"
+        return text.split(maxsplit=1)[0][1:].split('@', 1)[0]
+
+    def resolve_message(self, text):
+        if not text:
+            return None
+
+        if text.startswith('/'):
+            return self.routes['command'].get(self.get_command(text))
+
+        return self.routes['text'].get(text)
+
+    def resolve_callback(self, callback_type):
+        return self.routes['callback'].get(callback_type)
+
+    def dispatch_message(self, text, *args):
+        return self.call(self.resolve_message(text), *args)
+
+    def dispatch_callback(self, callback_type, *args):
+        return self.call(self.resolve_callback(callback_type), *args)
+
+    def call(self, handler, *args):
+        if handler is None:
+            return False
+
+        error = False
+        start = time.perf_counter()
+
+        try:
+            handler(*args)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.observe(handler.__qualname__, time.perf_counter() - start, error)
+
+        return True
+
+    def observe(self, name, duration, error):
+        HANDLER_DURATION.observe(duration, self.name, name)
+
+        if error:
+            HANDLER_ERRORS.inc(self.name, name)
+
+        self.stats.observe(name, duration, error)
+
+    def get_stats(self):
+        return self.stats.get()
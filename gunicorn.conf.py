@@ -0,0 +1,22 @@
+from config import AppConfig
+
+# Loaded by `gunicorn app:app`. The app is imported once in the master and the
+# workers fork from it; the update and send queues, the Redis pool and the HTTP
+# session start their threads and connections per process after the fork.
+# Per-chat update ordering, next-step handlers of the bot flows and send rate
+# limits are kept in Redis, so a chat's updates may land on any worker.
+bind = f'{AppConfig.HOST or "0.0.0.0"}:{AppConfig.PORT or 4200}'
+workers = AppConfig.WEB_WORKERS
+threads = AppConfig.WEB_THREADS
+worker_class = 'gthread'
+timeout = AppConfig.WEB_TIMEOUT
+preload_app = True
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    # Database connections opened in the master must not be shared by workers
+    from app import app, db
+
+    with app.app_context():
+        db.engine.dispose(close=False)
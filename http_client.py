@@ -0,0 +1,98 @@
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import AppConfig
+from metrics import CallStats, Counter, Histogram
+
+UPSTREAM_DURATION = Histogram('upstream_request_duration_seconds', 'Outbound HTTP call latency', ('endpoint',))
+UPSTREAM_ERRORS = Counter('upstream_request_errors_total', 'Outbound HTTP calls that failed', ('endpoint',))
+
+
+class HttpClient:
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self):
+        self.timeout = (AppConfig.HTTP_CONNECT_TIMEOUT, AppConfig.HTTP_READ_TIMEOUT)
+        self.stats = CallStats()
+        self.pid = None
+        self._session = None
+        self.lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Pooled sockets must not be shared with a forked process
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self._session = self.create_session()
+                    self.pid = os.getpid()
+
+        return self._session
+
+    def create_session(self):
+        # Idempotent requests are retried on errors and 5xx responses, POST only
+        # on connection errors, so a message is never sent twice
+        retry = Retry(
+            total=AppConfig.HTTP_RETRIES,
+            backoff_factor=AppConfig.HTTP_BACKOFF,
+            status_forcelist=self.RETRY_STATUSES,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=AppConfig.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=AppConfig.HTTP_POOL_SIZE,
+            max_retries=retry,
+        )
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return session
+
+    @staticmethod
+    def get_endpoint(url):
+        parts = urlsplit(url)
+        path = re.sub(r'/bot[^/]+/', '/bot<token>/', parts.path)
+        return f'{parts.netloc}{path}'
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = self.get_endpoint(url)
+        error = False
+        start = time.perf_counter()
+
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            error = True
+            raise
+        finally:
+            self.observe(endpoint, time.perf_counter() - start, error)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def observe(self, endpoint, duration, error):
+        UPSTREAM_DURATION.observe(duration, endpoint)
+
+        if error:
+            UPSTREAM_ERRORS.inc(endpoint)
+
+        self.stats.observe(endpoint, duration, error)
+
+    def get_stats(self):
+        return self.stats.get()
+
+
+http_client = HttpClient()
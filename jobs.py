@@ -0,0 +1,152 @@
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from redis import RedisError
+
+from app import app
+from bot import bot, update_rates, send_reminders
+from config import AppConfig
+from http_client import http_client
+from redis_client import get_redis
+from scheduler import Scheduler, every
+from send_queue import drain_send_queues
+
+logger = logging.getLogger(__name__)
+
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+# One process across all hosts holds the Redis key and runs the jobs. The key
+# expires unless renewed, so a crashed leader is replaced after `ttl` seconds.
+# Leadership is assumed locally for only part of the ttl, which leaves a margin
+# for a slow renewal before another process can take over.
+class LeaderLock:
+    def __init__(self, name, ttl=None):
+        self.key = f'leader:{name}'
+        self.ttl = ttl or AppConfig.JOBS_LOCK_TTL
+        self.token = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+        self.expires_at = 0
+
+    def is_leader(self):
+        return time.monotonic() < self.expires_at
+
+    def refresh(self):
+        started = time.monotonic()
+        r = get_redis()
+
+        try:
+            held = bool(r.eval(RENEW_SCRIPT, 1, self.key, self.token, int(self.ttl * 1000)))
+            held = held or bool(r.set(self.key, self.token, nx=True, px=int(self.ttl * 1000)))
+        except RedisError as error:
+            logger.warning(f'Leader lock {self.key} error: {error}')
+            held = False
+
+        self.expires_at = started + self.ttl * 2 / 3 if held else 0
+        return held
+
+    def release(self):
+        self.expires_at = 0
+
+        try:
+            get_redis().eval(RELEASE_SCRIPT, 1, self.key, self.token)
+        except RedisError as error:
+            logger.warning(f'Leader lock {self.key} release error: {error}')
+
+
+leader = LeaderLock('jobs')
+
+
+def heartbeat(scheduler):
+    was_leader = leader.is_leader()
+
+    if leader.refresh() != was_leader:
+        logger.info('Became the jobs leader' if not was_leader else 'Lost the jobs leadership')
+
+        # Every new leader points the webhooks at this deployment once
+        if not was_leader:
+            scheduler.add(leader_only(register_webhooks))
+
+
+def keep_leadership(scheduler, stopped):
+    # The lease is renewed on its own thread, so a long job (a reminders run
+    # blocked on the send queue) can not outlast it
+    while not stopped.wait(leader.ttl / 3):
+        try:
+            heartbeat(scheduler)
+        except Exception:
+            logger.exception('Jobs heartbeat failed')
+
+
+def leader_only(job):
+    # Followers keep the job in the schedule and check again after a heartbeat
+    def guarded():
+        if not leader.is_leader():
+            return time.time() + leader.ttl / 3
+
+        return job()
+
+    guarded.__name__ = job.__name__
+    return guarded
+
+
+def register_webhooks():
+    url = f'{AppConfig.SERVER_URL}/{AppConfig.TELEGRAM_BOT_TOKEN}'
+    http_client.post(AppConfig.TELEGRAM_URL + 'setWebhook', json={'url': url})
+
+    bot.remove_webhook()
+    bot.set_webhook(url=f'{AppConfig.SERVER_URL}/{AppConfig.TELEGRAM_TOKEN}')
+
+
+def remind():
+    # Stop between batches once the lease is lost, the new leader sends the rest
+    return send_reminders(leader.is_leader)
+
+
+def run_jobs():
+    # Webhooks are registered whenever leadership is gained, rates are fetched,
+    # stored to Redis and checked against alerts every hour, payment reminders
+    # go out whenever the next one is due
+    scheduler = Scheduler()
+    stopped = threading.Event()
+    heartbeat(scheduler)
+    thread = threading.Thread(target=keep_leadership, args=(scheduler, stopped), name='jobs-heartbeat', daemon=True)
+    thread.start()
+
+    try:
+        scheduler.add(leader_only(every(AppConfig.RATES_UPDATE_INTERVAL, update_rates)))
+        scheduler.add(leader_only(remind))
+        scheduler.run()
+    finally:
+        stopped.set()
+        thread.join()
+        leader.release()
+        # Reminders and alerts are marked as sent once queued, so the queued
+        # messages go out before the process exits
+        drain_send_queues(AppConfig.SEND_DRAIN_TIMEOUT)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # Let a stopping container hand the lock over right away, then send what
+    # is still queued
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    app.logger.info(f'Jobs process {leader.token} started')
+    run_jobs()
@@ -0,0 +1,364 @@
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import click
+
+MIX = 'command=40,text=30,callback=20,edited=10'
+CITIES = ('Kyiv', 'Lviv', 'Odesa', 'Kharkiv', 'Dnipro', 'London', 'Berlin', 'Warsaw')
+
+# target: (commands, keyboard texts). The telebot bot answers most of the menu,
+# the raw webhook bot only knows /rates and /weather and answers the rest
+# with "Unknown command".
+MESSAGES = {
+    'bot': (('/start', '/help', '/rates', '/lends', '/borrows', '/payments', '/forecast'),
+            ('💵 Rates', '💸 Lends', '💰 Borrows', '✅ Payments')),
+    'bot_handler': (('/rates', *(f'/weather {city}' for city in CITIES)), ('Hello',)),
+}
+
+
+def get_coordinates(city):
+    rnd = random.Random(city)
+    return round(rnd.uniform(-60, 60), 4), round(rnd.uniform(-180, 180), 4)
+
+
+# Stands in for the Bot API, Binance and Open-Meteo on one local port. Every
+# call sleeps `latency` seconds to mimic a network round trip.
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0
+    calls = {}
+    lock = threading.Lock()
+    message_ids = itertools.count(1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def reply(self, body):
+        time.sleep(self.latency)
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == '/api/v3/ticker/price':
+            self.count('binance')
+            symbols = json.loads(params['symbols']) if 'symbols' in params else [params.get('symbol')]
+            rates = [{'symbol': symbol, 'price': f'{random.uniform(1000, 70000):.2f}'} for symbol in symbols]
+            self.reply(rates if 'symbols' in params else rates[0])
+        elif url.path == '/v1/search':
+            self.count('open-meteo geo')
+            name = params.get('name', '')
+            lat, lon = get_coordinates(name)
+            self.reply({'results': [
+                {'name': name, 'admin1': 'Region', 'country_code': 'UA', 'latitude': lat, 'longitude': lon}
+            ]})
+        elif url.path == '/v1/forecast':
+            self.count('open-meteo weather')
+            self.reply({'current_weather': {
+                'temperature': 12.3, 'windspeed': 5.4, 'winddirection': 180, 'weathercode': 1, 'is_day': 1,
+                'time': datetime.utcnow().strftime('%Y-%m-%dT%H:%M'), 'interval': 900,
+            }})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        method = self.path.rsplit('/', 1)[-1]
+        self.count(f'telegram {method}')
+        self.reply({'ok': True, 'result': {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': payload.get('chat_id'), 'type': 'private'},
+            'text': payload.get('text'),
+        }})
+
+
+def start_stub(latency):
+    StubHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def seed(db, users, records):
+    from amortization import get_next_due_date
+    from models import Payment, Record, TypeEnum, User
+
+    existing = {user.username for user in db.session.query(User).filter(User.username.like('loadtest-%'))}
+    now = datetime.utcnow()
+
+    for index in range(users):
+        username = f'loadtest-{index}'
+
+        if username in existing:
+            continue
+
+        user = User(username=username, tg_id=str(900000000 + index), is_bot=False, language_code='en',
+                    first_name='Load', last_name=f'Test {index}')
+        db.session.add(user)
+        db.session.flush()
+
+        for number in range(records):
+            amount, months = 1000.0 * (number + 1), 12
+            payment_amount = round(amount / months, 2)
+            paid = payment_amount * (number % 3)
+            last_date = now + timedelta(days=30 * (months - number % 3))
+            record = Record(user_id=user.id, type=TypeEnum.LEND if number % 2 else TypeEnum.BORROW,
+                            name=f'Record {number}', amount=amount, remains=amount - paid, paid_total=paid,
+                            months=months, payment_amount=payment_amount, payment_day=1 + number % 28,
+                            last_date=last_date, next_due_date=get_next_due_date(
+                                amount, months, payment_amount, 1 + number % 28, last_date, paid))
+            db.session.add(record)
+            db.session.flush()
+
+            for payment in range(number % 3):
+                db.session.add(Payment(user_id=user.id, record_id=record.id, amount=payment_amount,
+                                       remains=amount - payment_amount * (payment + 1),
+                                       payment_date=now - timedelta(days=30 * (2 - payment))))
+
+        db.session.commit()
+
+    chats = {}
+
+    for user in db.session.query(User).filter(User.username.like('loadtest-%')).order_by(User.id).limit(users):
+        chats[int(user.tg_id)] = {
+            'user': {'id': int(user.tg_id), 'is_bot': False, 'first_name': user.first_name,
+                     'last_name': user.last_name, 'username': user.username, 'language_code': user.language_code},
+            'records': [(record.id, record.type.value) for record in user.records],
+            'payments': [payment.id for payment in user.payments],
+        }
+
+    return chats
+
+
+class UpdateFactory:
+    def __init__(self, chats, rnd):
+        self.chats = chats
+        self.random = rnd
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def get_user(self, chat_id):
+        return self.chats[chat_id]['user']
+
+    def get_message(self, chat_id, text):
+        message = {
+            'message_id': next(self.message_ids),
+            'from': self.get_user(chat_id),
+            'chat': {'id': chat_id, 'first_name': self.chats[chat_id]['user']['first_name'], 'type': 'private'},
+            'date': int(time.time()),
+            'text': text,
+        }
+
+        if text.startswith('/'):
+            message['entities'] = [{'offset': 0, 'length': len(text.split()[0]), 'type': 'bot_command'}]
+
+        return message
+
+    def get_callback_data(self, target, chat_id):
+        from callback_data import encode_callback
+
+        if target == 'bot_handler':
+            lat, lon = get_coordinates(self.random.choice(CITIES))
+            return encode_callback('weather', lat=lat, lon=lon)
+
+        chat = self.chats[chat_id]
+        choices = [('payments', {})]
+
+        if chat['records']:
+            record_id, record_type = self.random.choice(chat['records'])
+            choices += [('record-detail', {'id': record_id}), ('records', {'record_type': record_type}),
+                        ('records', {'record_type': record_type, 'after': record_id})]
+        if chat['payments']:
+            choices.append(('payment-detail', {'id': self.random.choice(chat['payments'])}))
+
+        callback_type, values = self.random.choice(choices)
+        return encode_callback(callback_type, **values)
+
+    def get_update(self, target, kind):
+        chat_id = self.random.choice(list(self.chats))
+        commands, texts = MESSAGES[target]
+        update = {'update_id': next(self.update_ids)}
+
+        if kind == 'callback':
+            update['callback_query'] = {
+                'id': str(update['update_id']),
+                'from': self.get_user(chat_id),
+                'message': self.get_message(chat_id, 'Select what you want in menu'),
+                'chat_instance': str(chat_id),
+                'data': self.get_callback_data(target, chat_id),
+            }
+        elif kind == 'edited':
+            message = self.get_message(chat_id, self.random.choice(commands))
+            update['edited_message'] = {**message, 'edit_date': message['date']}
+        else:
+            update['message'] = self.get_message(chat_id, self.random.choice(commands if kind == 'command' else texts))
+
+        return update
+
+
+def parse_mix(mix):
+    weights = {}
+
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+
+        if kind.strip() not in ('command', 'text', 'callback', 'edited'):
+            raise click.BadParameter(f'Unknown update kind "{kind}"', param_hint='--mix')
+
+        weights[kind.strip()] = float(weight or 1)
+
+    return weights
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[max(0, math.ceil(percentile / 100 * len(values)) - 1)]
+
+
+def get_latency_report(values):
+    return {f'p{percentile}': round(get_percentile(values, percentile) * 1000, 3) for percentile in (50, 95, 99)}
+
+
+def wait_for_send_queues(send_queues, timeout):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if not any(queue.get_stats()['depth'] for queue in send_queues.values()):
+            return
+        time.sleep(0.05)
+
+
+@click.command()
+@click.option('--updates', default=2000, show_default=True, help='Number of updates to send.')
+@click.option('--rate', default=0.0, show_default=True, help='Updates per second, 0 sends as fast as possible.')
+@click.option('--mix', default=MIX, show_default=True, help='Weights of command, text, callback and edited updates.')
+@click.option('--target', type=click.Choice(('both', 'bot', 'bot_handler')), default='both', show_default=True,
+              help='Webhook to drive: telebot bot, raw webhook bot or both.')
+@click.option('--users', default=100, show_default=True, help='Chats sending updates.')
+@click.option('--records', default=6, show_default=True, help='Records seeded per user.')
+@click.option('--database', default=None, help='Database URI, a temporary SQLite file by default.')
+@click.option('--upstream-latency', default=0.0, show_default=True, help='Seconds every stubbed upstream call takes.')
+@click.option('--seed', 'random_seed', default=1, show_default=True, help='Random seed of the update stream.')
+@click.option('--report', default=None, type=click.Path(dir_okay=False), help='Write the report as JSON.')
+@click.option('--max-p95', default=None, type=float, help='Exit with 1 if handled p95 is above this many ms.')
+def main(updates, rate, mix, target, users, records, database, upstream_latency, random_seed, report, max_p95):
+    """Drive generated Telegram updates through the webhooks against local stubs."""
+    weights = parse_mix(mix)
+    stub_url = start_stub(upstream_latency)
+
+    # Config is read on import, so the environment is set up before the app
+    os.environ.update({
+        'TELEGRAM_API_URL': stub_url,
+        'BINANCE_API_URL': stub_url,
+        'OPEN_METEO_API_URL': stub_url,
+        'OPEN_METEO_GEO_URL': stub_url,
+        'DATABASE_URI': database or f'sqlite:///{tempfile.mkdtemp()}/loadtest.sqlite',
+    })
+
+    for name, value in (('TELEGRAM_TOKEN', '100:loadtest'), ('TELEGRAM_BOT_TOKEN', '200:loadtest'),
+                        ('SECRET_KEY', 'loadtest'), ('SEND_GLOBAL_RATE', '100000'),
+                        ('SEND_CHAT_RATE', '100000'), ('SEND_QUEUE_SIZE', '100000')):
+        os.environ.setdefault(name, value)
+
+    from app import app, db
+    from config import AppConfig
+    from dispatcher import dispatchers
+    from http_client import http_client
+    from migrations import migrate
+    from send_queue import send_queues
+    from views import update_queue
+
+    with app.app_context():
+        migrate(log=lambda message: None)
+        chats = seed(db, users, records)
+
+    rnd = random.Random(random_seed)
+    factory = UpdateFactory(chats, rnd)
+    targets = ('bot', 'bot_handler') if target == 'both' else (target,)
+    paths = {'bot': f'/{AppConfig.TELEGRAM_TOKEN}', 'bot_handler': f'/{AppConfig.TELEGRAM_BOT_TOKEN}'}
+    kinds = rnd.choices(list(weights), list(weights.values()), k=updates)
+    stream = [(name, kind, factory.get_update(name, kind)) for name, kind in zip(itertools.cycle(targets), kinds)]
+
+    handled = []
+    update_queue.listeners.append(lambda handler, duration: handled.append(duration))
+    webhook = []
+    rejected = 0
+    client = app.test_client()
+    start = time.perf_counter()
+
+    for index, (name, kind, update) in enumerate(stream):
+        if rate and (delay := start + index / rate - time.perf_counter()) > 0:
+            time.sleep(delay)
+
+        sent_at = time.perf_counter()
+        response = client.post(paths[name], json=update)
+        webhook.append(time.perf_counter() - sent_at)
+        rejected += response.status_code != 200
+
+    update_queue.join()
+    elapsed = time.perf_counter() - start
+    wait_for_send_queues(send_queues, 30)
+
+    result = {
+        'updates': updates,
+        'rejected': rejected,
+        'mix': {kind: kinds.count(kind) for kind in weights},
+        'elapsed': round(elapsed, 3),
+        'updates_per_second': round(len(handled) / elapsed, 1),
+        'webhook_ms': get_latency_report(webhook),
+        'handled_ms': get_latency_report(handled),
+        'handlers': {f'{bot}.{name}': {key: round(value * 1000, 3) if key in ('total', 'max', 'avg') else value
+                                       for key, value in stat.items()}
+                     for bot, dispatcher in dispatchers.items() for name, stat in dispatcher.get_stats().items()},
+        'upstream': dict(sorted(StubHandler.calls.items())),
+        'upstream_ms': {endpoint: round(stat['avg'] * 1000, 3) for endpoint, stat in http_client.get_stats().items()},
+    }
+
+    click.echo(f'updates     {updates} ({", ".join(f"{kind} {count}" for kind, count in result["mix"].items())}), '
+               f'rejected {rejected}')
+    click.echo(f'throughput  {result["updates_per_second"]} updates/s in {result["elapsed"]} s')
+
+    for label, key in (('webhook', 'webhook_ms'), ('handled', 'handled_ms')):
+        click.echo(f'{label:<11} ' + '  '.join(f'{name} {value} ms' for name, value in result[key].items()))
+
+    for name, stat in sorted(result['handlers'].items(), key=lambda item: -item[1]['total']):
+        click.echo(f'  {name:<40} {stat["count"]:>6}  avg {stat["avg"]} ms  max {stat["max"]} ms')
+
+    click.echo('upstream    ' + ', '.join(f'{name} {count}' for name, count in result['upstream'].items()))
+
+    if report:
+        with open(report, 'w') as file:
+            json.dump(result, file, indent=2, ensure_ascii=False)
+
+    if max_p95 is not None and result['handled_ms']['p95'] > max_p95:
+        click.echo(f'Handled p95 {result["handled_ms"]["p95"]} ms is above {max_p95} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
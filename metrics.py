@@ -0,0 +1,219 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+metrics = []
+collectors = []
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+
+        for labels, value in values.items():
+            yield self.name, format_labels(self.labels, labels), value
+
+
+# Bucket counts are kept per bucket and only summed up on scrape, so observe()
+# is a bisect and two additions under a lock
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+
+        with self.lock:
+            state = self.values.get(labels)
+
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+
+        for labels, (counts, total) in values.items():
+            cumulative = 0
+
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', format_labels((*self.labels, 'le'), (*labels, bound)), cumulative
+
+            yield f'{self.name}_sum', format_labels(self.labels, labels), total
+            yield f'{self.name}_count', format_labels(self.labels, labels), cumulative
+
+
+# Count, errors and latency per call name, read by reports such as the load
+# test rather than by the scrape
+class CallStats:
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, duration, error):
+        with self.lock:
+            stat = self.stats.setdefault(name, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+            stat['count'] += 1
+            stat['errors'] += int(error)
+            stat['total'] += duration
+            stat['max'] = max(stat['max'], duration)
+
+    def get(self):
+        with self.lock:
+            return {name: {**stat, 'avg': stat['total'] / stat['count']} for name, stat in self.stats.items()}
+
+
+# Values read from other modules' stats at scrape time
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, format_labels(self.labels, labels), value
+
+
+# Totals another module already counts, reported as a counter
+class CounterSnapshot(Gauge):
+    type = 'counter'
+
+
+def collector(fn):
+    collectors.append(fn)
+    return fn
+
+
+def render():
+    families = list(metrics)
+
+    for fn in collectors:
+        families.extend(fn())
+
+    lines = []
+
+    for family in families:
+        lines.append(f'# HELP {family.name} {family.description}')
+        lines.append(f'# TYPE {family.name} {family.type}')
+        lines.extend(f'{name}{labels} {value}' for name, labels, value in family.samples())
+
+    return '\n'.join(lines) + '\n'
+
+
+# SQL executed while a request or a bot update is handled is counted against
+# it. The scope lives in a context variable, so worker threads don't mix up;
+# a scope opened inside another one counts towards both.
+class QueryScope:
+    def __init__(self, name, label=None):
+        self.name = name
+        self.label = label or name
+        self.parent = current_scope.get()
+        self.queries = 0
+        self.duration = 0.0
+
+    def observe(self, conn, statement, parameters, duration):
+        self.queries += 1
+        self.duration += duration
+
+    def finish(self):
+        pass
+
+
+current_scope = ContextVar('current_scope', default=None)
+
+DB_QUERY_DURATION = Histogram('db_query_duration_seconds', 'SQL statement duration', ('operation',))
+SCOPE_QUERIES = Histogram('scope_db_queries', 'SQL statements per request or bot update', ('scope',),
+                          buckets=QUERY_COUNT_BUCKETS)
+SCOPE_DB_DURATION = Histogram('scope_db_duration_seconds', 'Time spent in SQL per request or bot update', ('scope',))
+
+
+def start_scope(name, scope_class=QueryScope, label=None):
+    scope = scope_class(name, label)
+    return scope, current_scope.set(scope)
+
+
+def finish_scope(scope, token):
+    current_scope.reset(token)
+    SCOPE_QUERIES.observe(scope.queries, scope.name)
+    SCOPE_DB_DURATION.observe(scope.duration, scope.name)
+    scope.finish()
+
+
+@contextmanager
+def track_queries(name, scope_class=QueryScope, label=None):
+    scope, token = start_scope(name, scope_class, label)
+
+    try:
+        yield scope
+    finally:
+        finish_scope(scope, token)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    DB_QUERY_DURATION.observe(duration, statement.lstrip().split(None, 1)[0].upper())
+
+    scope = current_scope.get()
+
+    while scope:
+        scope.observe(conn, statement, parameters, duration)
+        scope = scope.parent
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
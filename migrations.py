@@ -0,0 +1,229 @@
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.orm import with_parent
+
+from amortization import PaymentSchedule
+from app import db
+from config import AppConfig
+from models import User, Record, Payment, TypeEnum
+from pagination import IdPagination
+from services import PaymentService, RecordService, ReminderService, UserService
+
+
+def create_index(connection, name, table, columns, unique=False):
+    quote = connection.dialect.identifier_preparer.quote
+    unique = 'UNIQUE ' if unique else ''
+    columns = ', '.join(quote(column) for column in columns)
+
+    if connection.dialect.name == 'postgresql':
+        # A failed concurrent build leaves an invalid index behind, rebuild it
+        invalid = connection.execute(db.text(
+            'SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+            'WHERE pg_class.relname = :name AND NOT pg_index.indisvalid'
+        ), {'name': name}).first()
+
+        if invalid:
+            connection.execute(db.text(f'DROP INDEX CONCURRENTLY IF EXISTS {quote(name)}'))
+
+        connection.execute(db.text(
+            f'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {quote(name)} ON {quote(table)} ({columns})'
+        ))
+    else:
+        connection.execute(db.text(f'CREATE {unique}INDEX IF NOT EXISTS {quote(name)} ON {quote(table)} ({columns})'))
+
+
+def baseline(connection):
+    db.metadata.create_all(bind=connection)
+
+
+def add_record_paid_total(connection):
+    columns = [column['name'] for column in db.inspect(connection).get_columns('record')]
+
+    # A constant default makes this a catalog-only change on Postgres 11+
+    if 'paid_total' not in columns:
+        connection.execute(db.text('ALTER TABLE record ADD COLUMN paid_total FLOAT NOT NULL DEFAULT 0'))
+
+    rebuild_balances(connection)
+
+
+def add_pagination_indexes(connection):
+    create_index(connection, 'ix_user_created_at_id', 'user', ['created_at', 'id'])
+    create_index(connection, 'ix_record_created_at_id', 'record', ['created_at', 'id'])
+    create_index(connection, 'ix_payment_created_at_id', 'payment', ['created_at', 'id'])
+
+
+def add_lookup_indexes(connection):
+    create_index(connection, 'ix_user_tg_id', 'user', ['tg_id'], unique=True)
+    create_index(connection, 'ix_record_user_id_type', 'record', ['user_id', 'type'])
+    create_index(connection, 'ix_payment_user_id', 'payment', ['user_id'])
+    create_index(connection, 'ix_payment_record_id', 'payment', ['record_id'])
+
+
+def add_record_next_due_date(connection):
+    columns = [column['name'] for column in db.inspect(connection).get_columns('record')]
+
+    if 'next_due_date' not in columns:
+        connection.execute(db.text('ALTER TABLE record ADD COLUMN next_due_date TIMESTAMP'))
+    if 'reminder_sent' not in columns:
+        connection.execute(db.text('ALTER TABLE record ADD COLUMN reminder_sent BOOLEAN NOT NULL DEFAULT FALSE'))
+
+    rebuild_due_dates(connection)
+
+    # Installments already past due get no reminder for the backlog
+    connection.execute(
+        db.update(Record).where(Record.next_due_date < datetime.utcnow()).values(reminder_sent=True)
+    )
+    create_index(connection, 'ix_record_reminder_sent_next_due_date', 'record', ['reminder_sent', 'next_due_date'])
+
+
+def rebuild_record_next_due_date(connection):
+    # Records without a payment_amount were due in their first month, not the last
+    rebuild_due_dates(connection)
+
+
+# Append only. Every step runs outside of a transaction (CREATE INDEX
+# CONCURRENTLY requires it), so each one has to be safe to re-run.
+MIGRATIONS = (
+    (1, 'baseline', baseline),
+    (2, 'add record paid_total', add_record_paid_total),
+    (3, 'add pagination indexes', add_pagination_indexes),
+    (4, 'add lookup indexes', add_lookup_indexes),
+    (5, 'add record next_due_date', add_record_next_due_date),
+    (6, 'rebuild record next_due_date', rebuild_record_next_due_date),
+)
+
+schema_version = db.Table(
+    'schema_version',
+    db.MetaData(),
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.String, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False),
+)
+
+
+def rebuild_balances(connection):
+    paid = db.select(func.coalesce(func.sum(Payment.amount), 0)) \
+        .where(Payment.record_id == Record.id) \
+        .scalar_subquery()
+
+    result = connection.execute(db.update(Record).values(paid_total=paid, remains=Record.amount - paid))
+    return result.rowcount
+
+
+def rebuild_due_dates(connection, chunk_size=10000, after_id=0):
+    query = db.select(
+        Record.id,
+        (Record.type == TypeEnum.LEND).label('is_lend'),
+        Record.amount,
+        Record.paid_total,
+        Record.months,
+        Record.payment_amount,
+        Record.payment_day,
+        Record.last_date,
+    ).order_by(Record.id)
+    count, last_id = 0, after_id
+
+    while rows := connection.execute(query.where(Record.id > last_id).limit(chunk_size)).all():
+        schedule = PaymentSchedule.from_rows(rows)
+        due_dates = schedule.get_next_due_by_paid([row.paid_total for row in rows])
+
+        connection.execute(
+            db.update(Record).where(Record.id == db.bindparam('record_id')).values(next_due_date=db.bindparam('due_date')),
+            [{'record_id': row.id, 'due_date': due_date} for row, due_date in zip(rows, due_dates)],
+        )
+        count, last_id = count + len(rows), rows[-1].id
+
+    return count
+
+
+def get_applied_versions(connection):
+    schema_version.create(bind=connection, checkfirst=True)
+    return set(connection.execute(db.select(schema_version.c.version)).scalars())
+
+
+def migrate(log=print):
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        applied = get_applied_versions(connection)
+
+        for version, name, step in MIGRATIONS:
+            if version in applied:
+                continue
+
+            log(f'Applying {version}: {name}')
+            step(connection)
+            connection.execute(schema_version.insert().values(version=version, name=name, applied_at=datetime.utcnow()))
+
+
+def get_pending_migrations():
+    with db.engine.connect() as connection:
+        applied = get_applied_versions(connection)
+        connection.commit()
+
+    return [(version, name) for version, name, _ in MIGRATIONS if version not in applied]
+
+
+# The queries services.py runs on every bot update, built by the services
+# themselves from placeholder arguments
+def get_hot_queries():
+    records = RecordService.get_records_query(0, TypeEnum.LEND)
+    payments = PaymentService.get_payments_query(0)
+    queries = {
+        'UserService upsert by tg_id': UserService.get_upsert_query(0, dict.fromkeys(UserService.PROFILE_FIELDS)),
+        'UserService id by tg_id': UserService.get_id_query(0),
+        'RecordService.get_records': records,
+        'RecordService.get_record': RecordService.get_record_query(0, 0),
+        'PaymentService.get_payments': payments,
+        'PaymentService.get_payment': PaymentService.get_payment_query(0, 0),
+        'PaymentService.update_paid_total': PaymentService.get_paid_total_query(0, 0),
+        'Payments of a record': db.select(Payment).where(with_parent(Record(id=0), Record.payments)),
+        'ReminderService.get_due_reminders': ReminderService(datetime(1970, 1, 1)).get_due_reminders_query(),
+        'ReminderService.get_next_remind_at': ReminderService.get_next_due_query(),
+    }
+
+    # Bot list pages move through the keyset in both directions
+    for cursor in ('after', 'before'):
+        params = {'size': AppConfig.BOT_PAGE_SIZE, cursor: '0'}
+        queries[f'RecordService.get_records_page {cursor}'] = IdPagination(Record, params).apply(records)
+        queries[f'PaymentService.get_payments_page {cursor}'] = IdPagination(Payment, params).apply(payments)
+
+    return queries
+
+
+def get_plan_seq_scans(plan):
+    scans = []
+
+    if plan.get('Node Type') == 'Seq Scan':
+        scans.append(plan.get('Relation Name'))
+
+    for child in plan.get('Plans', []):
+        scans.extend(get_plan_seq_scans(child))
+
+    return scans
+
+
+def get_seq_scans(connection, query):
+    sql = str(query.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+
+    if connection.dialect.name == 'postgresql':
+        # With sequential scans disabled the planner still picks one when no
+        # index fits, which is what we want to find regardless of table size
+        connection.execute(db.text('SET LOCAL enable_seqscan = off'))
+        plan = connection.execute(db.text(f'EXPLAIN (FORMAT JSON) {sql}')).scalar()
+        return get_plan_seq_scans(plan[0]['Plan'])
+
+    rows = connection.execute(db.text(f'EXPLAIN QUERY PLAN {sql}')).all()
+    return [row[-1] for row in rows if row[-1].startswith('SCAN ')]
+
+
+def check_query_plans():
+    problems = {}
+
+    with db.engine.connect() as connection:
+        for name, query in get_hot_queries().items():
+            if scans := get_seq_scans(connection, query):
+                problems[name] = scans
+
+        connection.rollback()
+
+    return problems
@@ -12,7 +12,7 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String, unique=True, nullable=False)
     phone = db.Column(db.String(20), unique=True)
-    tg_id = db.Column(db.String(20))
+    tg_id = db.Column(db.String(20), unique=True, index=True)
     is_bot = db.Column(db.Boolean)
     language_code = db.Column(db.String(20))
     first_name = db.Column(db.String)
@@ -23,6 +23,10 @@ class User(db.Model):
     records = db.relationship('Record', backref='user', lazy=True)
     payments = db.relationship('Payment', backref='user', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_user_created_at_id', 'created_at', 'id'),
+    )
+
 
 class Record(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -32,15 +36,24 @@ class Record(db.Model):
     name = db.Column(db.String, nullable=False)
     amount = db.Column(db.Float, nullable=False)
     remains = db.Column(db.Float, nullable=False)
+    paid_total = db.Column(db.Float, nullable=False, default=0, server_default=db.text('0'))
     months = db.Column(db.Integer, nullable=False)
     payment_amount = db.Column(db.Float, nullable=False)
     payment_day = db.Column(db.Integer, nullable=False)
     last_date = db.Column(db.DateTime, nullable=False)
+    next_due_date = db.Column(db.DateTime)
+    reminder_sent = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
 
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=db.text('CURRENT_TIMESTAMP'))
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=db.text('CURRENT_TIMESTAMP'), onupdate=db.text('CURRENT_TIMESTAMP'))
     payments = db.relationship('Payment', backref='record', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_record_created_at_id', 'created_at', 'id'),
+        db.Index('ix_record_user_id_type', 'user_id', 'type'),
+        db.Index('ix_record_reminder_sent_next_due_date', 'reminder_sent', 'next_due_date'),
+    )
+
 
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -51,3 +64,9 @@ class Payment(db.Model):
     payment_date = db.Column(db.DateTime, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=db.text('CURRENT_TIMESTAMP'))
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=db.text('CURRENT_TIMESTAMP'), onupdate=db.text('CURRENT_TIMESTAMP'))
+
+    __table_args__ = (
+        db.Index('ix_payment_created_at_id', 'created_at', 'id'),
+        db.Index('ix_payment_user_id', 'user_id'),
+        db.Index('ix_payment_record_id', 'record_id'),
+    )
@@ -0,0 +1,119 @@
+import base64
+import binascii
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from config import AppConfig
+
+
+class PaginationException(Exception):
+    pass
+
+
+def encode_cursor(created_at, item_id):
+    raw = f'{created_at.isoformat()}|{item_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, item_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(item_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise PaginationException('Invalid cursor value')
+
+
+# Cursor pagination ordered by (created_at, id). Only the page itself plus one
+# look-ahead row is read, so deep pages cost the same as the first one.
+class KeysetPagination:
+    def __init__(self, model, params):
+        self.model = model
+        self.after = params.get('after') or None
+        self.before = params.get('before') or None
+        self.next_cursor = None
+        self.prev_cursor = None
+
+        if self.after and self.before:
+            raise PaginationException('Use either after or before cursor, not both')
+
+        try:
+            size = int(params.get('size')) if params.get('size') else AppConfig.PAGE_SIZE
+        except ValueError:
+            raise PaginationException('Invalid size value')
+
+        if size < 1:
+            raise PaginationException('Invalid size value')
+
+        self.size = min(size, AppConfig.MAX_PAGE_SIZE)
+
+    @property
+    def columns(self):
+        return self.model.created_at, self.model.id
+
+    @property
+    def key(self):
+        return tuple_(*self.columns)
+
+    def encode(self, item):
+        return encode_cursor(item.created_at, item.id)
+
+    def decode(self, cursor):
+        return decode_cursor(cursor)
+
+    def apply(self, query):
+        if self.before:
+            query = query.where(self.key < self.decode(self.before))
+            query = query.order_by(*(column.desc() for column in self.columns))
+        else:
+            if self.after:
+                query = query.where(self.key > self.decode(self.after))
+            query = query.order_by(*self.columns)
+
+        return query.limit(self.size + 1)
+
+    def paginate(self, items, key=lambda item: item):
+        has_more = len(items) > self.size
+        items = list(items[:self.size])
+
+        if self.before:
+            items.reverse()
+
+        if items:
+            first, last = key(items[0]), key(items[-1])
+
+            if (self.before and has_more) or self.after:
+                self.prev_cursor = self.encode(first)
+            if (not self.before and has_more) or self.before:
+                self.next_cursor = self.encode(last)
+
+        return items
+
+    def get_context(self):
+        return {
+            'size': self.size,
+            'next_cursor': self.next_cursor,
+            'prev_cursor': self.prev_cursor,
+        }
+
+
+# Ordered by id alone, so a cursor is a bare id short enough for the 64 bytes
+# of Telegram callback data
+class IdPagination(KeysetPagination):
+    @property
+    def columns(self):
+        return self.model.id,
+
+    @property
+    def key(self):
+        return self.model.id
+
+    def encode(self, item):
+        return item.id
+
+    def decode(self, cursor):
+        try:
+            return int(cursor)
+        except ValueError:
+            raise PaginationException('Invalid cursor value')
@@ -0,0 +1,86 @@
+import logging
+import re
+
+from config import AppConfig
+from metrics import QueryScope
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDERS = re.compile(r"%\(\w+\)s|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PLACEHOLDER_LISTS = re.compile(r'\(\?(?:\s*,\s*\?)+\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+class QueryDebugException(Exception):
+    pass
+
+
+# "SELECT ... WHERE id IN (?, ?, ?)" and "... IN (?)" are the same shape, so a
+# loop loading rows one by one is caught however many ids it goes through
+def get_shape(statement):
+    shape = PLACEHOLDERS.sub('?', WHITESPACE.sub(' ', statement).strip())
+    return PLACEHOLDER_LISTS.sub('(?)', shape)
+
+
+def explain(conn, statement, parameters):
+    prefix = 'EXPLAIN' if conn.dialect.name == 'postgresql' else 'EXPLAIN QUERY PLAN'
+    # The raw DBAPI cursor bypasses engine events, so EXPLAIN is neither timed
+    # nor counted against the scope. It runs in a savepoint: a failed statement
+    # would otherwise abort the request's own transaction on Postgres.
+    cursor = conn.connection.cursor()
+
+    try:
+        cursor.execute('SAVEPOINT query_debug_explain')
+
+        try:
+            cursor.execute(f'{prefix} {statement}', parameters)
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+        except Exception as error:
+            cursor.execute('ROLLBACK TO SAVEPOINT query_debug_explain')
+            return f'EXPLAIN failed: {error}'
+        finally:
+            cursor.execute('RELEASE SAVEPOINT query_debug_explain')
+    except Exception as error:
+        return f'EXPLAIN failed: {error}'
+    finally:
+        cursor.close()
+
+
+# Development and staging mode (QUERY_DEBUG=log or raise): SQL of a request or a
+# bot update is grouped by statement shape, a shape repeated more than
+# QUERY_REPEAT_LIMIT times is reported as a likely N+1, and statements slower
+# than SLOW_QUERY_MS are logged with their plan
+class QueryDebugScope(QueryScope):
+    def __init__(self, name, label=None, limit=None, strict=None):
+        super().__init__(name, label)
+        self.limit = AppConfig.QUERY_REPEAT_LIMIT if limit is None else limit
+        self.strict = AppConfig.QUERY_DEBUG == 'raise' if strict is None else strict
+        self.shapes = {}
+
+    def observe(self, conn, statement, parameters, duration):
+        super().observe(conn, statement, parameters, duration)
+
+        shape = get_shape(statement)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+        if duration * 1000 >= AppConfig.SLOW_QUERY_MS:
+            plan = explain(conn, statement, parameters) if isinstance(parameters, (dict, tuple)) else 'executemany'
+            logger.warning(f'Slow query in {self.label} ({duration * 1000:.1f} ms): {statement}\n{plan}')
+
+    def get_repeats(self):
+        return {shape: count for shape, count in self.shapes.items() if count > self.limit}
+
+    def finish(self):
+        if not (repeats := self.get_repeats()):
+            return
+
+        message = f'{self.label} ran {self.queries} queries, repeated: ' + '; '.join(
+            f'{count}x {shape}' for shape, count in sorted(repeats.items(), key=lambda item: -item[1]))
+
+        if self.strict:
+            raise QueryDebugException(message)
+
+        logger.warning(message)
+
+
+scope_class = QueryDebugScope if AppConfig.QUERY_DEBUG else QueryScope
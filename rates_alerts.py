@@ -0,0 +1,59 @@
+import math
+
+
+class RatesAlertsException(Exception):
+    pass
+
+
+# Thresholds live in one sorted set per pair and direction scored by the
+# threshold, so a tick only reads and removes the alerts it actually crossed
+class RatesAlerts:
+    DIRECTIONS = ('above', 'below')
+
+    def __init__(self, r):
+        self.r = r
+
+    @staticmethod
+    def get_key(pair, direction):
+        return f'alerts:{direction}:{pair}'
+
+    def subscribe(self, chat_id, pair, direction, threshold):
+        if direction not in self.DIRECTIONS:
+            raise RatesAlertsException(f'Direction must be one of: {", ".join(self.DIRECTIONS)}')
+
+        try:
+            threshold = float(threshold)
+        except ValueError:
+            raise RatesAlertsException('Invalid threshold value')
+
+        # inf and nan parse as floats but can never be crossed
+        if not math.isfinite(threshold):
+            raise RatesAlertsException('Threshold must be a finite number')
+
+        self.r.zadd(self.get_key(pair, direction), {f'{chat_id}:{threshold!r}': threshold})
+
+        return threshold
+
+    def pop_crossed(self, rates):
+        pipe = self.r.pipeline()
+        ranges = []
+
+        for pair, price in rates.items():
+            price = float(price)
+
+            for direction in self.DIRECTIONS:
+                key = self.get_key(pair, direction)
+                low, high = ('-inf', price) if direction == 'above' else (price, '+inf')
+                ranges.append((pair, direction, price))
+                pipe.zrangebyscore(key, low, high)
+                pipe.zremrangebyscore(key, low, high)
+
+        fired = {}
+        results = pipe.execute()
+
+        for (pair, direction, price), members in zip(ranges, results[::2]):
+            for member in members:
+                chat_id, threshold = member.rsplit(':', 1)
+                fired.setdefault(int(chat_id), []).append((pair, direction, float(threshold), price))
+
+        return fired
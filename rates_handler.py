@@ -1,33 +1,128 @@
-import redis
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+from cache import TTLCache
 from config import AppConfig
+from http_client import http_client
+from rates_alerts import RatesAlerts
+from rates_history import RatesHistory
+from redis_client import get_redis
+
+ONE_MINUTE = 60
+
+logger = logging.getLogger(__name__)
+
+# Stored rates only change when the scheduler fetches new ones
+rates_cache = TTLCache(AppConfig.RATES_UPDATE_INTERVAL)
 
 
 class RatesHandler:
-    PROVIDER_URL = 'https://api.binance.com/api/v3/ticker/price'
-    CURRENCY_PAIRS = ('BTCUSDT', 'ETHUSDT')
+    PROVIDER_URL = f'{AppConfig.BINANCE_API_URL}/api/v3/ticker/price'
+    CURRENCY_PAIRS = AppConfig.CURRENCY_PAIRS
 
     def __init__(self):
-        self.r = redis.StrictRedis(host=AppConfig.REDIS_HOST, port=AppConfig.REDIS_PORT, decode_responses=True)
+        self.r = get_redis()
+        self.history = RatesHistory(self.r)
+        self.alerts = RatesAlerts(self.r)
 
     def update_rates(self):
-        self.store_rates(self.request_rates())
+        rates = self.request_rates()
+        self.store_rates(rates)
+        rates_cache.clear()
+        return rates
 
     def store_rates(self, rates):
-        self.r.hmset('rates', rates)
+        if not rates:
+            return
+
+        timestamp = int(time.time())
+
+        pipe = self.r.pipeline()
+        pipe.hset('rates', mapping=rates)
+        pipe.set('rates:updated_at', timestamp)
+        self.history.add(rates, pipe, timestamp)
+        pipe.execute()
+
+    @staticmethod
+    def get_cache_ttl(updated_at):
+        # Expire together with the next scheduled fetch, so processes which did
+        # not run the fetch themselves pick up new rates as well
+        if updated_at is None:
+            return ONE_MINUTE
+
+        return max(int(updated_at) + AppConfig.RATES_UPDATE_INTERVAL - time.time(), ONE_MINUTE)
 
     def get_stored_rates(self):
-        return self.r.hgetall('rates')
+        rates = rates_cache.get('rates')
 
-    def request_rates(self, pairs=None):
-        rates = {}
+        if rates is None:
+            pipe = self.r.pipeline(transaction=False)
+            pipe.hgetall('rates')
+            pipe.get('rates:updated_at')
+            rates, updated_at = pipe.execute()
+
+            ttl = self.get_cache_ttl(updated_at)
+            rates_cache.set('rates', rates, ttl)
+            rates_cache.set('updated_at', updated_at, ttl)
+
+        return rates
+
+    def get_daily_stats(self):
+        stats = rates_cache.get('stats')
 
+        if stats is None:
+            stats = self.history.get_daily_stats(self.CURRENCY_PAIRS)
+            rates_cache.set('stats', stats, self.get_cache_ttl(rates_cache.get('updated_at')))
+
+        return stats
+
+    def get_rates_text(self):
+        rates = self.get_stored_rates()
+        stats = self.get_daily_stats()
+        lines = ['<b>Rates</b> (24h change, high / low)']
+
+        for pair in self.CURRENCY_PAIRS:
+            line = f'{pair}: {rates.get(pair)}'
+
+            if stat := stats.get(pair):
+                line += f' ({stat["change_percent"]:+.2f}%, {stat["high"]} / {stat["low"]})'
+
+            lines.append(line)
+
+        return '\n'.join(lines)
+
+    def request_rates(self, pairs=None):
         if pairs is None:
             pairs = self.CURRENCY_PAIRS
 
-        for pair in pairs:
-            response = requests.get(self.PROVIDER_URL, params={'symbol': pair})
-            rates[pair] = response.json()['price']
+        # One request for all symbols, the whole batch fails if any symbol is
+        # unknown to the provider, so fall back to concurrent single requests
+        try:
+            return self.request_rates_batch(pairs)
+        except (requests.RequestException, ValueError, KeyError, TypeError) as error:
+            logger.warning(f'Batch rates request failed: {error}')
+            return self.request_rates_concurrently(pairs)
 
-        return rates
+    def request_rates_batch(self, pairs):
+        response = http_client.get(self.PROVIDER_URL, params={'symbols': json.dumps(list(pairs), separators=(',', ':'))})
+        response.raise_for_status()
+
+        return {item['symbol']: item['price'] for item in response.json()}
+
+    def request_rate(self, pair):
+        try:
+            response = http_client.get(self.PROVIDER_URL, params={'symbol': pair})
+            response.raise_for_status()
+            return response.json()['price']
+        except (requests.RequestException, ValueError, KeyError) as error:
+            logger.warning(f'Rate request for {pair} failed: {error}')
+
+    def request_rates_concurrently(self, pairs):
+        with ThreadPoolExecutor(max_workers=min(len(pairs), AppConfig.HTTP_POOL_SIZE) or 1) as executor:
+            prices = executor.map(self.request_rate, pairs)
+
+        return {pair: price for pair, price in zip(pairs, prices) if price is not None}
@@ -0,0 +1,100 @@
+import time
+
+ONE_MINUTE = 60
+ONE_HOUR = 60 * ONE_MINUTE
+ONE_DAY = 24 * ONE_HOUR
+
+
+# Every fetch is kept as a raw tick and folded into OHLC buckets of each
+# resolution. Members are '<bucket>:<open>:<high>:<low>:<close>' scored by the
+# bucket start, so trimming and range reads are plain sorted set operations.
+class RatesHistory:
+    TICKS_RETENTION = ONE_DAY
+    RESOLUTIONS = (
+        ('1m', ONE_MINUTE, ONE_DAY),
+        ('1h', ONE_HOUR, 30 * ONE_DAY),
+        ('1d', ONE_DAY, 2 * 365 * ONE_DAY),
+    )
+
+    def __init__(self, r):
+        self.r = r
+
+    @staticmethod
+    def get_key(pair, resolution):
+        return f'rates:{resolution}:{pair}'
+
+    @staticmethod
+    def encode(bucket, ohlc):
+        return ':'.join([str(bucket), *(repr(value) for value in ohlc)])
+
+    @staticmethod
+    def decode(member):
+        bucket, *ohlc = member.split(':')
+        return int(bucket), tuple(float(value) for value in ohlc)
+
+    def add(self, rates, pipe, timestamp=None):
+        timestamp = int(timestamp or time.time())
+        buckets = []
+
+        read_pipe = self.r.pipeline(transaction=False)
+
+        for pair in rates:
+            for resolution, step, retention in self.RESOLUTIONS:
+                bucket = timestamp - timestamp % step
+                buckets.append((pair, resolution, retention, bucket))
+                read_pipe.zrangebyscore(self.get_key(pair, resolution), bucket, bucket)
+
+        for (pair, resolution, retention, bucket), members in zip(buckets, read_pipe.execute()):
+            price = float(rates[pair])
+
+            if members:
+                _, (open_price, high, low, _) = self.decode(members[0])
+                ohlc = (open_price, max(high, price), min(low, price), price)
+            else:
+                ohlc = (price, price, price, price)
+
+            key = self.get_key(pair, resolution)
+            pipe.zremrangebyscore(key, bucket, bucket)
+            pipe.zadd(key, {self.encode(bucket, ohlc): bucket})
+            pipe.zremrangebyscore(key, '-inf', f'({timestamp - retention}')
+
+        for pair, price in rates.items():
+            key = self.get_key(pair, 'ticks')
+            pipe.zadd(key, {f'{timestamp}:{price}': timestamp})
+            pipe.zremrangebyscore(key, '-inf', f'({timestamp - self.TICKS_RETENTION}')
+
+        return pipe
+
+    def get_ohlc(self, pair, resolution, start, end='+inf'):
+        members = self.r.zrangebyscore(self.get_key(pair, resolution), start, end)
+        return [self.decode(member) for member in members]
+
+    def get_daily_stats(self, pairs, timestamp=None):
+        timestamp = int(timestamp or time.time())
+        start = timestamp - ONE_DAY
+        start -= start % ONE_HOUR
+
+        pipe = self.r.pipeline(transaction=False)
+
+        for pair in pairs:
+            pipe.zrangebyscore(self.get_key(pair, '1h'), start, '+inf')
+
+        stats = {}
+
+        for pair, members in zip(pairs, pipe.execute()):
+            if not members:
+                continue
+
+            buckets = [self.decode(member)[1] for member in members]
+            open_price, close = buckets[0][0], buckets[-1][3]
+
+            stats[pair] = {
+                'open': open_price,
+                'high': max(bucket[1] for bucket in buckets),
+                'low': min(bucket[2] for bucket in buckets),
+                'close': close,
+                'change': close - open_price,
+                'change_percent': (close - open_price) / open_price * 100 if open_price else 0.0,
+            }
+
+        return stats
@@ -0,0 +1,15 @@
+import redis
+
+from config import AppConfig
+
+# One pool per process, redis-py resets it by itself after a fork
+pool = redis.ConnectionPool(
+    host=AppConfig.REDIS_HOST,
+    port=AppConfig.REDIS_PORT,
+    max_connections=AppConfig.REDIS_MAX_CONNECTIONS,
+    decode_responses=True,
+)
+
+
+def get_redis():
+    return redis.StrictRedis(connection_pool=pool)
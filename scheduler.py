@@ -1,14 +1,62 @@
-import schedule
+import heapq
+import itertools
+import logging
+import threading
 import time
 
 ONE_MINUTE = 60
 
+logger = logging.getLogger(__name__)
 
-def run_schedule(update_rates):
-    # Run it first time
-    update_rates()
-    schedule.every().hour.do(update_rates)
 
-    while True:
-        schedule.run_pending()
-        time.sleep(ONE_MINUTE)
+# Jobs are kept in a heap ordered by their next run time and the thread sleeps
+# until the earliest one is due. A job returns the timestamp it wants to run at
+# next, or None to be dropped.
+class Scheduler:
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def add(self, job, run_at=None):
+        with self.condition:
+            heapq.heappush(self.heap, (run_at or time.time(), next(self.counter), job))
+            self.condition.notify()
+
+    def pop_due(self):
+        with self.condition:
+            while not self.heap or self.heap[0][0] > time.time():
+                self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+
+            return heapq.heappop(self.heap)[2]
+
+    def run(self):
+        while True:
+            job = self.pop_due()
+
+            try:
+                run_at = job()
+            except Exception:
+                logger.exception(f'Scheduled job {job.__name__} failed')
+                run_at = time.time() + ONE_MINUTE
+
+            if run_at is not None:
+                self.add(job, run_at)
+
+
+def every(interval, fn):
+    def job():
+        fn()
+        return time.time() + interval
+
+    job.__name__ = fn.__name__
+    return job
+
+
+def run_schedule(*jobs):
+    scheduler = Scheduler()
+
+    for job in jobs:
+        scheduler.add(job)
+
+    scheduler.run()
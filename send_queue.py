@@ -0,0 +1,295 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from redis import RedisError
+
+from config import AppConfig
+from http_client import http_client
+from metrics import CounterSnapshot, Gauge, collector
+from redis_client import get_redis
+from workers import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+# Takes a token from every bucket in KEYS at once, or returns how long to wait
+# until all of them have one. ARGV holds the rate and capacity of each bucket.
+TAKE_SCRIPT = """
+local now = redis.call('time')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local tokens = {}
+local delay = 0
+for i, key in ipairs(KEYS) do
+    local rate, capacity = tonumber(ARGV[i * 2 - 1]), tonumber(ARGV[i * 2])
+    local state = redis.call('hmget', key, 'tokens', 'updated')
+    local elapsed = math.max(0, now - (tonumber(state[2]) or now))
+    tokens[i] = math.min(capacity, (tonumber(state[1]) or capacity) + elapsed * rate)
+    delay = math.max(delay, (1 - tokens[i]) / rate)
+end
+if delay > 0 then
+    return tostring(delay)
+end
+for i, key in ipairs(KEYS) do
+    redis.call('hset', key, 'tokens', tostring(tokens[i] - 1), 'updated', tostring(now))
+    redis.call('expire', key, math.ceil(tonumber(ARGV[i * 2]) / tonumber(ARGV[i * 2 - 1])) + 1)
+end
+return '0'
+"""
+
+send_queues = {}
+
+
+class SendQueueException(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_delay(self, now):
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class Chat:
+    def __init__(self):
+        self.messages = deque()
+        self.bucket = TokenBucket(AppConfig.SEND_CHAT_RATE, AppConfig.SEND_CHAT_BURST)
+        self.scheduled = False
+
+
+# Outgoing Bot API calls of one bot token. Messages of a chat are sent in order
+# and no faster than the per-chat bucket allows, all chats together share the
+# global bucket. The buckets are kept in Redis, so every process sending with
+# the token (web workers and jobs) shares the limits. The chat waiting longest
+# goes first, and a 429 puts its chat on hold for retry_after seconds.
+class SendQueue(WorkerPool):
+    def __init__(self, name, url, workers=None, size=None):
+        super().__init__()
+        self.name = name
+        self.url = url
+        self.workers = workers or AppConfig.SEND_WORKERS
+        self.size = size or AppConfig.SEND_QUEUE_SIZE
+        self.condition = threading.Condition(self.lock)
+        self.reset()
+        send_queues[name] = self
+
+    def reset(self):
+        self.chats = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.depth = 0
+        self.bucket = TokenBucket(AppConfig.SEND_GLOBAL_RATE, 1)
+        self.stats = {'sent': 0, 'failed': 0, 'throttled': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+
+    def start_workers(self):
+        self.reset()
+
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f'{self.name}-sender-{index}')
+            thread.daemon = True
+            thread.start()
+
+    def put(self, chat_id, method, payload, timeout=None):
+        self.start()
+        future = Future()
+
+        with self.condition:
+            # Producers wait for room instead of growing the queue without bound
+            if not self.condition.wait_for(lambda: self.depth < self.size, timeout):
+                raise SendQueueException('Send queue is full')
+
+            if chat_id not in self.chats and len(self.chats) >= self.size:
+                self.prune(time.monotonic())
+
+            chat = self.chats.setdefault(chat_id, Chat())
+            chat.messages.append([future, method, payload, time.monotonic(), 0])
+            self.depth += 1
+
+            if not chat.scheduled:
+                self.schedule(chat_id, chat, time.monotonic())
+
+        return future
+
+    def schedule(self, chat_id, chat, ready_at):
+        # A chat enters the heap only once its own bucket allows the next
+        # message, so it never holds up other chats at the top of the heap
+        chat.scheduled = True
+        ready_at = max(ready_at, time.monotonic() + chat.bucket.get_delay(time.monotonic()))
+        heapq.heappush(self.heap, (ready_at, next(self.counter), chat_id))
+        self.condition.notify_all()
+
+    def prune(self, now):
+        for chat_id in [chat_id for chat_id, chat in self.chats.items()
+                        if not chat.scheduled and chat.bucket.is_full(now)]:
+            del self.chats[chat_id]
+
+    def get_chat(self):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                ready_at, _, chat_id = self.heap[0]
+                delay = ready_at - time.monotonic()
+
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                heapq.heappop(self.heap)
+                return chat_id, self.chats[chat_id]
+
+    def get_message(self):
+        while True:
+            chat_id, chat = self.get_chat()
+            delay = self.take(chat_id, chat)
+
+            with self.condition:
+                # The chat stays scheduled, so no other sender takes it meanwhile
+                if delay > 0:
+                    heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), chat_id))
+                    self.condition.notify_all()
+                    continue
+
+                self.depth -= 1
+                self.condition.notify_all()
+
+                return chat_id, chat, chat.messages.popleft()
+
+    def take(self, chat_id, chat):
+        keys = (f'send:{self.name}:chat:{chat_id}', f'send:{self.name}:global')
+        args = (AppConfig.SEND_CHAT_RATE, AppConfig.SEND_CHAT_BURST, AppConfig.SEND_GLOBAL_RATE, 1)
+
+        try:
+            return float(get_redis().eval(TAKE_SCRIPT, len(keys), *keys, *args))
+        except RedisError as error:
+            logger.warning(f'{self.name} rate limit error: {error}')
+
+        # Without Redis each process keeps to the limits on its own
+        with self.lock:
+            now = time.monotonic()
+            delay = max(chat.bucket.get_delay(now), self.bucket.get_delay(now))
+
+            if delay <= 0:
+                chat.bucket.take(now)
+                self.bucket.take(now)
+
+            return delay
+
+    def run(self):
+        while True:
+            chat_id, chat, message = self.get_message()
+            future, method, payload, queued_at, attempts = message
+            retry_after = None
+
+            try:
+                response = http_client.post(f'{self.url}{method}', json=payload)
+
+                if response.status_code == 429 and attempts < AppConfig.SEND_MAX_RETRIES:
+                    retry_after = self.get_retry_after(response)
+                else:
+                    self.observe(queued_at, response.ok)
+                    future.set_result(response)
+
+                    if not response.ok:
+                        logger.error(f'{self.name} {method} to {chat_id} failed: {response.status_code} {response.text}')
+            except Exception as error:
+                self.observe(queued_at, False)
+                future.set_exception(error)
+                logger.error(f'{self.name} {method} to {chat_id} error: {error}')
+
+            with self.condition:
+                now = time.monotonic()
+
+                if retry_after is not None:
+                    self.stats['throttled'] += 1
+                    message[4] += 1
+                    chat.messages.appendleft(message)
+                    self.depth += 1
+                    self.schedule(chat_id, chat, now + retry_after)
+                elif chat.messages:
+                    self.schedule(chat_id, chat, now)
+                else:
+                    chat.scheduled = False
+                    self.condition.notify_all()
+
+    def drain(self, timeout=None):
+        # Waits until every queued call has been answered, the senders are
+        # daemon threads and would be dropped with whatever is left on exit
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not any(chat.scheduled for chat in self.chats.values()), timeout)
+
+    @staticmethod
+    def get_retry_after(response):
+        try:
+            return float(response.json()['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return float(response.headers.get('Retry-After', 1))
+
+    def observe(self, queued_at, ok):
+        latency = time.monotonic() - queued_at
+
+        with self.lock:
+            self.stats['sent' if ok else 'failed'] += 1
+            self.stats['latency_total'] += latency
+            self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+
+    def get_stats(self):
+        with self.lock:
+            done = self.stats['sent'] + self.stats['failed']
+
+            return {
+                **self.stats,
+                'depth': self.depth,
+                'chats': sum(chat.scheduled for chat in self.chats.values()),
+                'latency_avg': self.stats['latency_total'] / done if done else 0.0,
+            }
+
+
+def drain_send_queues(timeout):
+    deadline = time.monotonic() + timeout
+
+    for name, send_queue in send_queues.items():
+        if not send_queue.drain(max(0, deadline - time.monotonic())):
+            logger.warning(f'{name} stopped with {send_queue.get_stats()["depth"]} calls unsent')
+
+
+@collector
+def collect_send_queues():
+    messages = CounterSnapshot('send_queue_messages_total', 'Outgoing Bot API calls by result', ('queue', 'result'))
+    depth = Gauge('send_queue_depth', 'Outgoing Bot API calls waiting to be sent', ('queue',))
+    latency = CounterSnapshot('send_queue_latency_seconds_total', 'Time from enqueue to response', ('queue',))
+
+    for name, send_queue in send_queues.items():
+        stats = send_queue.get_stats()
+
+        for result in ('sent', 'failed', 'throttled'):
+            messages.set(stats[result], name, result)
+
+        depth.set(stats['depth'], name)
+        latency.set(stats['latency_total'], name)
+
+    return [messages, depth, latency]
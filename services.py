@@ -1,8 +1,60 @@
-import requests
-from sqlalchemy import and_, func
-
+import hashlib
+import json
+import logging
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+from requests import RequestException
+from sqlalchemy import and_, event, false, func, or_, update
+from redis import RedisError, WatchError
+from sqlalchemy.dialects import postgresql, sqlite
+
+from amortization import PaymentSchedule, get_next_due_date
 from app import db
+from cache import MISSING, SingleFlight, TwoTierCache, VersionedCache, caches
+from config import AppConfig
+from http_client import http_client
 from models import User, Record, TypeEnum, Payment
+from pagination import IdPagination
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+user_cache = TwoTierCache('user', AppConfig.USER_CACHE_SIZE, AppConfig.USER_CACHE_TTL, AppConfig.USER_CACHE_LOCAL_TTL)
+geo_cache = TwoTierCache('geo', AppConfig.GEO_CACHE_SIZE, AppConfig.GEO_CACHE_TTL)
+weather_cache = TwoTierCache('weather', AppConfig.WEATHER_CACHE_SIZE, AppConfig.WEATHER_CACHE_TTL)
+weather_flight = SingleFlight()
+render_cache = VersionedCache('render', AppConfig.RENDER_CACHE_TTL)
+
+
+# Every committed change of a user's records or payments bumps that user's data
+# version, whether it came from a service, a view or a bulk update
+def touch_user(session, user_id):
+    session.info.setdefault('touched_users', set()).add(user_id)
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_touched_users(session, context):
+    for item in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(item, (Record, Payment)):
+            touch_user(session, item.user_id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def bump_data_versions(session):
+    touched_users = session.info.pop('touched_users', ())
+
+    for user_id in touched_users:
+        render_cache.bump(user_id)
+
+    if touched_users:
+        portfolio_cache.mark_stale(touched_users)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_touched_users(session):
+    session.info.pop('touched_users', None)
 
 
 class UserServiceException(Exception):
@@ -21,7 +73,13 @@ class WeatherServiceException(Exception):
     pass
 
 
+class ForecastServiceException(Exception):
+    pass
+
+
 class UserService:
+    PROFILE_FIELDS = ('is_bot', 'language_code', 'username', 'first_name', 'last_name')
+
     def __init__(self, first_name, id, is_bot, language_code, last_name, username):
         self.id = None
         self.tg_id = id
@@ -31,15 +89,33 @@ class UserService:
         self.last_name = last_name
         self.language_code = language_code
 
+        # The hot path is a cache hit with an unchanged profile: no SQL at all
+        profile_hash = self.get_profile_hash()
+        cached = user_cache.get(str(id))
+
+        if cached is not MISSING and cached['hash'] == profile_hash:
+            self.id = cached['id']
+            return
+
         try:
-            user = User.query.filter_by(tg_id=str(id)).first()
+            self.upsert_user()
         except Exception as error:
-            raise UserServiceException(f'Get User Error: {error}')
+            db.session.rollback()
+            raise UserServiceException(f'Upsert User Error: {error}')
 
-        if user:
-            self.update_user(user)
-        else:
-            self.create_user()
+        user_cache.set(str(id), {'id': self.id, 'hash': profile_hash})
+
+    @staticmethod
+    def forget(tg_id):
+        if tg_id:
+            user_cache.delete(str(tg_id))
+
+    def get_profile(self):
+        return {field: getattr(self, field) for field in self.PROFILE_FIELDS}
+
+    def get_profile_hash(self):
+        profile = json.dumps(self.get_profile(), sort_keys=True, default=str)
+        return hashlib.blake2b(profile.encode(), digest_size=8).hexdigest()
 
     def get_user(self):
         return {
@@ -52,27 +128,34 @@ class UserService:
             'language_code': self.language_code,
         }
 
-    def create_user(self):
-        user = User(
-            tg_id=str(self.tg_id),
-            is_bot=self.is_bot,
-            language_code=self.language_code,
-            username=self.username,
-            first_name=self.first_name,
-            last_name=self.last_name,
-        )
+    @staticmethod
+    def get_upsert_query(tg_id, profile):
+        match db.engine.dialect.name:
+            case 'postgresql':
+                insert = postgresql.insert
+            case 'sqlite':
+                insert = sqlite.insert
+            case dialect:
+                raise UserServiceException(f'Upsert is not supported for {dialect}')
+
+        query = insert(User).values(tg_id=str(tg_id), **profile)
+
+        return query.on_conflict_do_update(
+            index_elements=[User.tg_id],
+            set_={**{field: query.excluded[field] for field in profile}, 'updated_at': func.now()},
+            where=or_(*(getattr(User, field).is_distinct_from(query.excluded[field]) for field in profile)),
+        ).returning(User.id)
 
-        db.session.add(user)
-        db.session.commit()
-        self.id = user.id
+    @staticmethod
+    def get_id_query(tg_id):
+        return db.select(User.id).where(User.tg_id == str(tg_id))
+
+    def upsert_user(self):
+        # An unchanged row is not written and returns nothing, its id is read instead
+        self.id = db.session.execute(self.get_upsert_query(self.tg_id, self.get_profile())).scalar_one_or_none()
 
-    def update_user(self, user):
-        self.id = user.id
-        user.is_bot = self.is_bot
-        user.language_code = self.language_code
-        user.username = self.username
-        user.first_name = self.first_name
-        user.last_name = self.last_name
+        if self.id is None:
+            self.id = db.session.execute(self.get_id_query(self.tg_id)).scalar_one()
 
         db.session.commit()
 
@@ -82,15 +165,28 @@ class RecordService:
         user = UserService(data.first_name, data.id, data.is_bot, data.language_code, data.last_name, data.username)
         self.user_id = user.id
 
+    @staticmethod
+    def get_records_query(user_id, record_type):
+        return db.select(Record).where(Record.user_id == user_id, Record.type == TypeEnum(record_type))
+
+    @staticmethod
+    def get_record_query(user_id, record_id):
+        return db.select(Record).where(Record.user_id == user_id, Record.id == int(record_id)).limit(1)
+
     def get_records(self, record_type):
-        record_type = TypeEnum(record_type)
-        records = Record.query.filter_by(user_id=self.user_id, type=record_type).all()
+        records = db.session.execute(self.get_records_query(self.user_id, record_type)).scalars().all()
         return records
 
     def get_record(self, record_id):
-        record = Record.query.filter_by(user_id=self.user_id, id=int(record_id)).first()
+        record = db.session.execute(self.get_record_query(self.user_id, record_id)).scalars().first()
         return record
 
+    def get_records_page(self, record_type, params):
+        pagination = IdPagination(Record, {'size': AppConfig.BOT_PAGE_SIZE, **params})
+        query = pagination.apply(self.get_records_query(self.user_id, record_type))
+        records = pagination.paginate(db.session.execute(query).scalars().all())
+        return records, pagination
+
     @staticmethod
     def delete_record(record_id):
         try:
@@ -113,6 +209,9 @@ class RecordService:
                 payment_amount=data['payment_amount'],
                 payment_day=data['payment_day'],
                 last_date=data['last_date'],
+                next_due_date=get_next_due_date(
+                    data['amount'], data['months'], data['payment_amount'], data['payment_day'], data['last_date']
+                ),
             )
 
             db.session.add(record)
@@ -127,40 +226,95 @@ class PaymentService:
         user = UserService(data.first_name, data.id, data.is_bot, data.language_code, data.last_name, data.username)
         self.user_id = user.id
 
+    @staticmethod
+    def get_payments_query(user_id):
+        return db.select(Payment).where(Payment.user_id == user_id)
+
+    @staticmethod
+    def get_payment_query(user_id, payment_id):
+        return db.select(Payment).where(Payment.user_id == user_id, Payment.id == int(payment_id)).limit(1)
+
     def get_payments(self):
-        payments = Payment.query.filter_by(user_id=self.user_id).all()
+        payments = db.session.execute(self.get_payments_query(self.user_id)).scalars().all()
         return payments
 
     def get_payment(self, payment_id):
-        payment = Payment.query.filter_by(user_id=self.user_id, id=int(payment_id)).first()
+        payment = db.session.execute(self.get_payment_query(self.user_id, payment_id)).scalars().first()
         return payment
 
+    def get_payments_page(self, params):
+        pagination = IdPagination(Payment, {'size': AppConfig.BOT_PAGE_SIZE, **params})
+        query = pagination.apply(self.get_payments_query(self.user_id))
+        payments = pagination.paginate(db.session.execute(query).scalars().all())
+        return payments, pagination
+
+    @staticmethod
+    def get_paid_total_query(record_id, amount):
+        # A single UPDATE ... RETURNING keeps the running total under the row lock,
+        # so concurrent payments for one record can not overwrite each other
+        return update(Record) \
+            .where(Record.id == record_id) \
+            .values(paid_total=Record.paid_total + amount, remains=Record.amount - Record.paid_total - amount) \
+            .returning(
+                Record.user_id,
+                Record.remains,
+                Record.paid_total,
+                Record.amount,
+                Record.months,
+                Record.payment_amount,
+                Record.payment_day,
+                Record.last_date,
+                Record.next_due_date,
+                Record.reminder_sent,
+            )
+
+    @staticmethod
+    def update_paid_total(record_id, amount):
+        result = db.session.execute(
+            PaymentService.get_paid_total_query(record_id, amount).execution_options(synchronize_session=False)
+        ).first()
+
+        if result is None:
+            raise PaymentServiceException(f'Record #{record_id} not found')
+
+        touch_user(db.session, result.user_id)
+
+        # The row is still locked, move the due date on to the first unpaid installment
+        next_due_date = get_next_due_date(
+            result.amount, result.months, result.payment_amount, result.payment_day, result.last_date, result.paid_total
+        )
+
+        if next_due_date != result.next_due_date:
+            db.session.execute(
+                update(Record)
+                .where(Record.id == record_id)
+                .values(next_due_date=next_due_date, reminder_sent=False)
+                .execution_options(synchronize_session=False)
+            )
+
+        return result.remains
+
     @staticmethod
     def delete_payment(payment_id):
         try:
             payment = Payment.query.get(payment_id)
+            PaymentService.update_paid_total(payment.record_id, -payment.amount)
             db.session.delete(payment)
             db.session.commit()
             return True
         except Exception as error:
+            db.session.rollback()
             raise PaymentServiceException(f'Delete Payment Error: {error}')
 
     def create_payment(self, data):
         try:
-            record = db.session.query(Record).get(data['record_id'])
-            payed = db.session.query(func.sum(Payment.amount)).filter(Payment.record_id == data['record_id']).one()
-
-            remains = record.amount - float(data['amount'])
-
-            if payed[0]:
-                remains -= payed[0]
-
-            record.remains = remains
+            amount = float(data['amount'])
+            remains = self.update_paid_total(data['record_id'], amount)
 
             payment = Payment(
                 user_id=self.user_id,
                 record_id=data['record_id'],
-                amount=data['amount'],
+                amount=amount,
                 payment_date=data['payment_date'],
                 remains=remains,
             )
@@ -169,39 +323,440 @@ class PaymentService:
             db.session.commit()
 
         except Exception as error:
+            db.session.rollback()
             raise PaymentServiceException(f'Create Payment Error: {error}')
 
 
+class ForecastService:
+    ARREARS_LIMIT = 10
+    TOTALS = ('records', 'lends_outstanding', 'borrows_outstanding', 'lends_arrears', 'borrows_arrears')
+
+    def __init__(self, user_id=None, as_of=None, user_ids=None):
+        self.user_ids = [user_id] if user_id is not None else user_ids
+        self.as_of = as_of or date.today()
+
+    def filter_users(self, query, column):
+        return query if self.user_ids is None else query.where(column.in_(self.user_ids))
+
+    def get_schedule(self):
+        query = db.select(
+            Record.id,
+            (Record.type == TypeEnum.LEND).label('is_lend'),
+            Record.amount,
+            Record.months,
+            Record.payment_amount,
+            Record.payment_day,
+            Record.last_date,
+            Record.paid_total,
+            Record.user_id,
+        ).order_by(Record.id)
+
+        # Plain column rows: ORM row processing costs more than the whole
+        # NumPy schedule on large portfolios
+        rows = db.session.connection().execute(self.filter_users(query, Record.user_id)).all()
+        paid_total = np.fromiter((row.paid_total for row in rows), dtype=np.float64, count=len(rows))
+        owners = np.fromiter((row.user_id for row in rows), dtype=np.int64, count=len(rows))
+
+        return PaymentSchedule.from_rows(rows), paid_total, owners
+
+    def get_paid(self, schedule, paid_total):
+        # Payments recorded up to the report date, aligned with schedule.ids:
+        # the running paid_total less the few payments dated after it, so the
+        # payment table is not summed up on every report
+        query = db.select(Payment.record_id, func.sum(Payment.amount)) \
+            .where(Payment.payment_date >= self.as_of + timedelta(days=1)) \
+            .group_by(Payment.record_id)
+
+        if self.user_ids is not None:
+            query = self.filter_users(query.join(Record, Payment.record_id == Record.id), Record.user_id)
+
+        rows = db.session.connection().execute(query).all()
+        paid = np.array(paid_total, dtype=np.float64)
+
+        if rows and len(schedule):
+            record_ids, totals = (np.asarray(column) for column in zip(*rows))
+            positions = np.minimum(np.searchsorted(schedule.ids, record_ids), len(schedule) - 1)
+            found = schedule.ids[positions] == record_ids
+            paid[positions[found]] -= totals[found]
+
+        return paid
+
+    @staticmethod
+    def get_names(record_ids):
+        query = db.select(Record.id, Record.name).where(Record.id.in_(record_ids))
+        return dict(db.session.connection().execute(query).all())
+
+    def get_portfolio(self, horizon=6):
+        try:
+            schedule, paid_total, _ = self.get_schedule()
+            paid = self.get_paid(schedule, paid_total)
+            arrears = schedule.get_arrears(paid, self.as_of)
+            overdue = np.flatnonzero(arrears > 0)
+            overdue = overdue[np.argsort(-arrears[overdue])][:self.ARREARS_LIMIT]
+            names = self.get_names(schedule.ids[overdue].tolist())
+        except Exception as error:
+            raise ForecastServiceException(f'Forecast Error: {error}')
+
+        outstanding = np.maximum(schedule.amount - paid, 0)
+
+        return {
+            'as_of': self.as_of,
+            'records': len(schedule),
+            'lends_outstanding': float(outstanding[schedule.is_lend].sum()),
+            'borrows_outstanding': float(outstanding[~schedule.is_lend].sum()),
+            'lends_arrears': float(arrears[schedule.is_lend].sum()),
+            'borrows_arrears': float(arrears[~schedule.is_lend].sum()),
+            'overdue': [(int(schedule.ids[i]), names[int(schedule.ids[i])], float(arrears[i])) for i in overdue],
+            'forecast': schedule.get_forecast(self.as_of, horizon),
+        }
+
+    def get_parts(self, horizon=6):
+        # The portfolio split by user. Every figure is a sum over records, so
+        # the all-users portfolio is the sum of the parts.
+        try:
+            schedule, paid_total, owners = self.get_schedule()
+            paid = self.get_paid(schedule, paid_total)
+        except Exception as error:
+            raise ForecastServiceException(f'Forecast Error: {error}')
+
+        users, index = np.unique(owners, return_inverse=True)
+        outstanding = np.maximum(schedule.amount - paid, 0)
+        arrears = schedule.get_arrears(paid, self.as_of)
+        pending = schedule.get_pending(self.as_of, horizon)
+        lend, borrow = schedule.is_lend, ~schedule.is_lend
+
+        def by_user(values):
+            return np.bincount(index, weights=values, minlength=len(users))
+
+        records = np.bincount(index, minlength=len(users))
+        sums = np.array([
+            by_user(outstanding * lend),
+            by_user(outstanding * borrow),
+            by_user(arrears * lend),
+            by_user(arrears * borrow),
+        ])
+        incoming = np.array([by_user(month * lend) for month in pending]).reshape(horizon, len(users))
+        outgoing = np.array([by_user(month * borrow) for month in pending]).reshape(horizon, len(users))
+
+        parts = {
+            int(user_id): {
+                'records': int(records[position]),
+                **dict(zip(self.TOTALS[1:], sums[:, position].tolist())),
+                'forecast': np.stack([incoming[:, position], outgoing[:, position]], axis=1).tolist(),
+                'overdue': {},
+            }
+            for position, user_id in enumerate(users)
+        }
+
+        # The most overdue records of each user: the all-users list is the top
+        # of their union
+        overdue = np.flatnonzero(arrears > 0)
+        overdue = overdue[np.lexsort((-arrears[overdue], index[overdue]))]
+        rank = np.arange(len(overdue)) - np.searchsorted(index[overdue], index[overdue])
+
+        for i in overdue[rank < self.ARREARS_LIMIT]:
+            parts[int(users[index[i]])]['overdue'][str(schedule.ids[i])] = float(arrears[i])
+
+        return parts
+
+    def get_cached_portfolio(self, horizon=6):
+        if self.user_ids is not None:
+            return self.get_portfolio(horizon)
+
+        return portfolio_cache.get(self, horizon)
+
+
+# The all-users portfolio is kept in Redis as per-user parts and their sum. A
+# commit only marks its users stale; the next read recomputes just those users
+# and moves the sum by the difference, so one write never rebuilds the whole
+# portfolio. A full rebuild happens when the report date changes.
+class PortfolioCache:
+    def __init__(self, name, ttl, retries=3):
+        self.name = name
+        self.ttl = ttl
+        self.retries = retries
+        self.stats = {'hits': 0, 'misses': 0, 'updates': 0}
+        caches[name] = self
+
+    def get_key(self, *parts):
+        return ':'.join(('cache', self.name, *map(str, parts)))
+
+    def mark_stale(self, user_ids):
+        try:
+            pipe = get_redis().pipeline()
+            pipe.sadd(self.get_key('stale'), *user_ids)
+            pipe.expire(self.get_key('stale'), self.ttl)
+            pipe.execute()
+        except RedisError as error:
+            logger.warning(f'Cache {self.name} write error: {error}')
+
+    def reset(self):
+        try:
+            r = get_redis()
+
+            for key in r.scan_iter(self.get_key('*')):
+                r.delete(key)
+        except RedisError as error:
+            logger.warning(f'Cache {self.name} reset error: {error}')
+
+    def get(self, service, horizon):
+        try:
+            totals = self.get_totals(service, horizon)
+        except RedisError as error:
+            logger.warning(f'Cache {self.name} read error: {error}')
+            return service.get_portfolio(horizon)
+
+        if totals is None:
+            # Writes kept racing the update: serve a direct computation
+            return service.get_portfolio(horizon)
+
+        try:
+            top = get_redis().zrevrange(self.get_key(horizon, 'overdue'), 0, service.ARREARS_LIMIT - 1, withscores=True)
+        except RedisError as error:
+            logger.warning(f'Cache {self.name} read error: {error}')
+            top = []
+
+        names = service.get_names([int(record_id) for record_id, _ in top])
+        months = PaymentSchedule.get_months(service.as_of, horizon)
+
+        return {
+            **{field: totals[field] for field in service.TOTALS},
+            'as_of': service.as_of,
+            'overdue': [(int(record_id), names.get(int(record_id), ''), arrears) for record_id, arrears in top],
+            'forecast': [(month, inflow, outflow) for month, (inflow, outflow) in zip(months, totals['forecast'])],
+        }
+
+    def get_totals(self, service, horizon):
+        # Other readers applying the same stale users race on the totals key:
+        # the transaction only commits if nobody changed it since it was read
+        with get_redis().pipeline() as pipe:
+            for attempt in range(self.retries):
+                try:
+                    pipe.watch(self.get_key(horizon, 'totals'))
+                    totals = json.loads(pipe.get(self.get_key(horizon, 'totals')) or 'null')
+                    stale = sorted(int(user_id) for user_id in pipe.smembers(self.get_key('stale')))
+
+                    if totals is None or totals['as_of'] != service.as_of.isoformat():
+                        self.stats['misses'] += 1
+                        return self.rebuild(pipe, service, horizon, stale)
+
+                    if stale:
+                        self.stats['updates'] += 1
+                        return self.update(pipe, service, horizon, totals, stale)
+
+                    self.stats['hits'] += 1
+                    return totals
+                except WatchError:
+                    continue
+
+        return None
+
+    @staticmethod
+    def add(totals, part, sign):
+        # Sums are rounded so that repeated updates do not drift into -0.00
+        return {
+            **totals,
+            'records': totals['records'] + sign * part['records'],
+            **{field: round(totals[field] + sign * part[field], 6) + 0.0 for field in ForecastService.TOTALS[1:]},
+            'forecast': [
+                [round(inflow + sign * part_inflow, 6) + 0.0, round(outflow + sign * part_outflow, 6) + 0.0]
+                for (inflow, outflow), (part_inflow, part_outflow) in zip(totals['forecast'], part['forecast'])
+            ],
+        }
+
+    def rebuild(self, pipe, service, horizon, stale):
+        parts = ForecastService(as_of=service.as_of).get_parts(horizon)
+        totals = {'as_of': service.as_of.isoformat(), **dict.fromkeys(service.TOTALS, 0), 'forecast': [[0, 0]] * horizon}
+
+        for part in parts.values():
+            totals = self.add(totals, part, 1)
+
+        pipe.multi()
+        pipe.delete(self.get_key(horizon, 'parts'), self.get_key(horizon, 'overdue'))
+        self.store(pipe, horizon, totals, parts, stale)
+        return totals
+
+    def update(self, pipe, service, horizon, totals, stale):
+        parts = ForecastService(as_of=service.as_of, user_ids=stale).get_parts(horizon)
+        previous = dict(zip(stale, pipe.hmget(self.get_key(horizon, 'parts'), stale)))
+        removed = []
+
+        for user_id in stale:
+            if previous[user_id]:
+                before = json.loads(previous[user_id])
+                totals = self.add(totals, before, -1)
+                removed.extend(before['overdue'])
+
+            if user_id in parts:
+                totals = self.add(totals, parts[user_id], 1)
+
+        pipe.multi()
+
+        if removed:
+            pipe.zrem(self.get_key(horizon, 'overdue'), *removed)
+
+        if deleted := [user_id for user_id in stale if user_id not in parts]:
+            pipe.hdel(self.get_key(horizon, 'parts'), *deleted)
+
+        self.store(pipe, horizon, totals, parts, stale)
+        return totals
+
+    def store(self, pipe, horizon, totals, parts, stale):
+        overdue = {record_id: arrears for part in parts.values() for record_id, arrears in part['overdue'].items()}
+
+        if parts:
+            pipe.hset(self.get_key(horizon, 'parts'), mapping={user_id: json.dumps(part) for user_id, part in parts.items()})
+
+        if overdue:
+            pipe.zadd(self.get_key(horizon, 'overdue'), overdue)
+
+        # Users marked after the stale set was read stay in it for the next read
+        if stale:
+            pipe.srem(self.get_key('stale'), *stale)
+
+        pipe.set(self.get_key(horizon, 'totals'), json.dumps(totals), ex=self.ttl)
+        pipe.expire(self.get_key(horizon, 'parts'), self.ttl)
+        pipe.expire(self.get_key(horizon, 'overdue'), self.ttl)
+        pipe.execute()
+
+    def get_stats(self):
+        return dict(self.stats)
+
+
+portfolio_cache = PortfolioCache('portfolio', AppConfig.PORTFOLIO_CACHE_TTL)
+
+
+class ReminderService:
+    def __init__(self, now=None):
+        self.now = now or datetime.utcnow()
+        self.lead = timedelta(days=AppConfig.REMINDER_DAYS_BEFORE, hours=-AppConfig.REMINDER_HOUR)
+
+    def get_remind_at(self, next_due_date):
+        return next_due_date - self.lead
+
+    def get_due_reminders_query(self):
+        # Served by ix_record_reminder_sent_next_due_date: only pending
+        # reminders are in the scanned range, however many records there are
+        return db.select(
+            Record.id,
+            Record.name,
+            Record.type,
+            Record.remains,
+            Record.payment_amount,
+            Record.next_due_date,
+            User.tg_id,
+        ).join(User, Record.user_id == User.id) \
+            .where(Record.reminder_sent == false(), Record.next_due_date <= self.now + self.lead) \
+            .order_by(Record.next_due_date, Record.id) \
+            .limit(AppConfig.REMINDER_BATCH_SIZE)
+
+    def get_due_reminders(self):
+        return db.session.execute(self.get_due_reminders_query()).all()
+
+    @staticmethod
+    def mark_sent(record_ids):
+        db.session.execute(
+            update(Record)
+            .where(Record.id.in_(record_ids))
+            .values(reminder_sent=True)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+    @staticmethod
+    def get_next_due_query():
+        return db.select(func.min(Record.next_due_date)).where(Record.reminder_sent == false())
+
+    def get_next_remind_at(self):
+        next_due_date = db.session.execute(self.get_next_due_query()).scalar()
+
+        return self.get_remind_at(next_due_date) if next_due_date else None
+
+
 class WeatherService:
-    GEO_URL = 'https://geocoding-api.open-meteo.com/v1/search'
-    WEATHER_URL = 'https://api.open-meteo.com/v1/forecast'
+    GEO_URL = f'{AppConfig.OPEN_METEO_GEO_URL}/v1/search'
+    WEATHER_URL = f'{AppConfig.OPEN_METEO_API_URL}/v1/forecast'
 
     @staticmethod
     def get_geo_data(city_name):
+        key = ' '.join(city_name.split()).casefold()
+        results = geo_cache.get(key)
+
+        if results is MISSING:
+            results = WeatherService.request_geo_data(city_name)
+            geo_cache.set(key, results, None if results else AppConfig.GEO_NEGATIVE_CACHE_TTL)
+
+        if not results:
+            raise WeatherServiceException('City not found')
+
+        return results
+
+    @staticmethod
+    def request_geo_data(city_name):
         params = {
             'name': city_name
         }
 
-        res = requests.get(f'{WeatherService.GEO_URL}', params=params)
-
-        if res.status_code != 200:
+        try:
+            res = http_client.get(f'{WeatherService.GEO_URL}', params=params)
+            res.raise_for_status()
+            return res.json().get('results') or None
+        except (RequestException, ValueError, AttributeError):
             raise WeatherServiceException('Can not get geo data')
-        elif not res.json().get('results'):
-            raise WeatherServiceException('City not found')
 
-        return res.json().get('results')
+    @staticmethod
+    def quantize(value):
+        grid = AppConfig.WEATHER_GRID
+        return round(round(float(value) / grid) * grid, 4)
+
+    @staticmethod
+    def get_weather_ttl(weather):
+        # Open-Meteo refreshes current weather every `interval` seconds from `time` (GMT)
+        try:
+            updated_at = datetime.strptime(weather['time'], '%Y-%m-%dT%H:%M').replace(tzinfo=timezone.utc)
+            expires_at = updated_at.timestamp() + int(weather['interval'])
+        except (KeyError, TypeError, ValueError):
+            return AppConfig.WEATHER_CACHE_TTL
+
+        return min(max(int(expires_at - time.time()), 60), AppConfig.WEATHER_CACHE_TTL)
 
     @staticmethod
     def get_current_weather_by_geo_data(lat, lon):
+        lat, lon = WeatherService.quantize(lat), WeatherService.quantize(lon)
+        key = f'{lat}:{lon}'
+        weather = weather_cache.get(key)
+
+        if weather is MISSING:
+            weather = weather_flight.do(key, WeatherService.load_current_weather, key, lat, lon)
+
+        return weather
+
+    @staticmethod
+    def load_current_weather(key, lat, lon):
+        # The flight leader looks again: a flight that ended after our cache miss
+        # has already stored the weather
+        weather = weather_cache.get(key)
+
+        if weather is MISSING:
+            weather = WeatherService.request_current_weather(lat, lon)
+
+        return weather
+
+    @staticmethod
+    def request_current_weather(lat, lon):
         params = {
             'latitude': lat,
             'longitude': lon,
             'current_weather': True
         }
 
-        res = requests.get(f'{WeatherService.WEATHER_URL}', params=params)
-
-        if res.status_code != 200:
+        try:
+            res = http_client.get(f'{WeatherService.WEATHER_URL}', params=params)
+            res.raise_for_status()
+            weather = res.json().get('current_weather')
+        except (RequestException, ValueError, AttributeError):
             raise WeatherServiceException('Can not get weather data')
 
-        return res.json().get('current_weather')
+        weather_cache.set(f'{lat}:{lon}', weather, WeatherService.get_weather_ttl(weather))
+
+        return weather
@@ -76,6 +76,39 @@ const xhrRequest = (method, url, formData, form, redirectUrl = null, message = n
     };
 };
 
+// Dropdowns are filled from a search endpoint that returns a capped list of
+// {id, text} options, optionally narrowed down to the selected user
+const fillOptions = (select, options) => {
+    const placeholder = select.options[0];
+    select.replaceChildren(placeholder, ...options.map(({id, text}) => new Option(text, id)));
+    placeholder.selected = true;
+};
+
+document.querySelectorAll('[data-options]').forEach((search) => {
+    const select = document.getElementById(search.dataset.target);
+    const user = search.dataset.user ? document.getElementById(search.dataset.user) : null;
+    let timer = null;
+
+    const load = () => {
+        const params = new URLSearchParams({q: search.value});
+        if (user && user.value && user.value !== '0') {
+            params.set('user_id', user.value);
+        }
+        get(`${search.dataset.options}?${params}`).then((options) => fillOptions(select, options));
+    };
+
+    search.addEventListener('input', () => {
+        clearTimeout(timer);
+        timer = setTimeout(load, 300);
+    });
+
+    if (user) {
+        user.addEventListener('change', load);
+    }
+
+    load();
+});
+
 const addUserForm = document.getElementById("addUserForm");
 if (addUserForm) {
     addUserForm.addEventListener("submit", (e) => {
@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The configuration is read when the app is imported, so the environment has to
+# be in place first. Redis may be absent: the caches fall back to the database.
+os.environ['DATABASE_URI'] = f'sqlite:///{os.path.join(tempfile.mkdtemp(), "test.sqlite")}'
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ.setdefault('TELEGRAM_TOKEN', '0:test')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '1:test')
+os.environ.setdefault('REDIS_HOST', '127.0.0.1')
+os.environ.setdefault('REDIS_PORT', '6379')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as flask_app, db  # noqa: E402
+from datagen import generate_data  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app():
+    with flask_app.app_context():
+        migrate(log=lambda message: None)
+
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+
+    with client.session_transaction() as session:
+        session['username'] = 'test'
+
+    return client
+
+
+@pytest.fixture
+def add_users(app):
+    def add(users, seed=1, **kwargs):
+        with app.app_context(), db.engine.connect() as connection:
+            return generate_data(connection, users, seed=seed, log=lambda message: None, **kwargs)
+
+    return add
@@ -0,0 +1,89 @@
+from datetime import date, datetime
+
+import numpy as np
+
+from amortization import PaymentSchedule, get_next_due_date
+
+
+def make_schedule(amount, months, payment_amount, payment_day, last_date, is_lend=True):
+    return PaymentSchedule([1], [is_lend], [amount], [months], [payment_amount], [payment_day], [last_date])
+
+
+def get_timeline(schedule):
+    timeline = schedule.get_timeline()
+    return [(due_date.astype(datetime), float(amount)) for due_date, amount in zip(timeline['due_date'], timeline['amount'])]
+
+
+def get_first_uncovered(schedule, paid):
+    # The reference: walk the timeline until the cumulative amount exceeds paid
+    total = 0
+
+    for due_date, amount in get_timeline(schedule):
+        total += amount
+
+        if total > paid + 1e-9:
+            return datetime.combine(due_date, datetime.min.time())
+
+    return None
+
+
+def test_timeline_splits_amount_into_installments():
+    schedule = make_schedule(1000, 4, 300, 10, datetime(2027, 4, 20))
+
+    assert get_timeline(schedule) == [
+        (date(2027, 1, 10), 300),
+        (date(2027, 2, 10), 300),
+        (date(2027, 3, 10), 300),
+        (date(2027, 4, 10), 100),
+    ]
+
+
+def test_zero_payment_amount_is_due_in_the_last_installment():
+    schedule = make_schedule(1200, 3, 0, 5, datetime(2027, 3, 5))
+
+    assert [amount for _, amount in get_timeline(schedule)] == [0, 0, 1200]
+    assert schedule.get_next_due_by_paid([0]) == [datetime(2027, 3, 5)]
+    assert schedule.get_next_due_by_paid([600]) == [datetime(2027, 3, 5)]
+    assert schedule.get_next_due_by_paid([1200]) == [None]
+    assert schedule.get_arrears(np.array([0.0]), date(2027, 2, 28)).tolist() == [0]
+    assert schedule.get_arrears(np.array([200.0]), date(2027, 3, 5)).tolist() == [1000]
+
+
+def test_partial_payments():
+    schedule = make_schedule(1000, 10, 100, 15, datetime(2027, 10, 15))
+
+    assert schedule.get_next_due_by_paid([250]) == [datetime(2027, 3, 15)]
+    assert schedule.get_next_due_by_paid([300]) == [datetime(2027, 4, 15)]
+    # Three installments are due by mid-March, 250 of their 300 is paid
+    assert schedule.get_arrears(np.array([250.0]), date(2027, 3, 15)).tolist() == [50]
+    assert schedule.get_arrears(np.array([250.0]), date(2027, 3, 14)).tolist() == [0]
+    assert get_next_due_date(1000, 10, 100, 15, '2027-10-15', paid_total=250) == datetime(2027, 3, 15)
+
+
+def test_payment_day_after_the_day_of_last_date_is_clamped_to_the_month():
+    schedule = make_schedule(400, 4, 100, 31, datetime(2027, 2, 15))
+
+    assert [due_date for due_date, _ in get_timeline(schedule)] == [
+        date(2026, 11, 30),
+        date(2026, 12, 31),
+        date(2027, 1, 31),
+        date(2027, 2, 28),
+    ]
+    assert schedule.get_next_due_by_paid([300]) == [datetime(2027, 2, 28)]
+    assert schedule.get_arrears(np.array([0.0]), date(2027, 2, 27)).tolist() == [300]
+    assert schedule.get_arrears(np.array([0.0]), date(2027, 2, 28)).tolist() == [400]
+
+
+def test_next_due_follows_the_timeline():
+    rng = np.random.default_rng(1)
+
+    for _ in range(500):
+        months = int(rng.integers(1, 13))
+        amount = float(rng.integers(1, 50) * 10)
+        payment_amount = float(rng.choice([0, amount / months, rng.integers(1, 60) * 5]))
+        schedule = make_schedule(amount, months, payment_amount, int(rng.integers(1, 32)),
+                                 datetime(2027, int(rng.integers(1, 13)), int(rng.integers(1, 29))))
+        paid = float(rng.choice([0, amount, rng.integers(0, int(amount)), payment_amount * rng.integers(0, months)]))
+
+        assert schedule.get_next_due_by_paid([paid]) == [get_first_uncovered(schedule, paid)], \
+            (amount, months, payment_amount, paid)
@@ -0,0 +1,60 @@
+from app import db
+from config import AppConfig
+from metrics import track_queries
+from models import Payment
+
+
+def count_queries(app, client, url):
+    with app.app_context(), track_queries('test') as scope:
+        response = client.get(url)
+
+    assert response.status_code == 200, f'GET {url}: {response.status_code}'
+    return scope.queries
+
+
+def get_last_payment_id(app):
+    with app.app_context():
+        return db.session.execute(db.select(db.func.max(Payment.id))).scalar()
+
+
+def count_payment_queries(app, client):
+    return {
+        'list': count_queries(app, client, '/payments'),
+        'detail': count_queries(app, client, f'/payments/{get_last_payment_id(app)}'),
+    }
+
+
+def test_payment_queries_do_not_grow_with_rows(app, client, add_users):
+    # A partly filled first page, then full pages: a query per row would show up
+    # as a difference between the two counts
+    totals = add_users(5, seed=1, records=1.0, payments=1.0)
+    assert 0 < totals['payments'] < AppConfig.PAGE_SIZE
+    # The first request warms up the connection, it is not counted
+    count_queries(app, client, '/payments')
+    before = count_payment_queries(app, client)
+
+    add_users(100, seed=2)
+    after = count_payment_queries(app, client)
+
+    assert before == after
+    assert after['detail'] == 1
+
+
+def get_sizes(client):
+    return {url: len(client.get(url).data) for url in ('/payments', '/payments/create', '/records', '/records/create')}
+
+
+def test_pages_do_not_grow_with_tables(app, client, add_users):
+    # Full pages at both sizes: the rendered HTML may only differ by the values
+    # in the rows, not by the number of users and records behind the dropdowns
+    add_users(100, seed=3)
+    before = get_sizes(client)
+
+    add_users(400, seed=4)
+    after = get_sizes(client)
+
+    for url, size in after.items():
+        assert size < before[url] * 1.1, f'GET {url}: {before[url]} -> {size} bytes'
+
+    for url in ('/users/options', '/records/options'):
+        assert len(client.get(url).json) == AppConfig.OPTIONS_LIMIT
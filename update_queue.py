@@ -0,0 +1,133 @@
+import logging
+import queue
+import threading
+import time
+
+from redis import RedisError
+
+from config import AppConfig
+from metrics import Histogram, track_queries
+from query_debug import scope_class
+from redis_client import get_redis
+from workers import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+ORDER_KEY_TTL = 24 * 60 * 60
+
+DONE_SCRIPT = """
+if tonumber(redis.call('get', KEYS[1]) or 0) < tonumber(ARGV[1]) then
+    redis.call('set', KEYS[1], ARGV[1], 'ex', ARGV[2])
+end
+return 0
+"""
+
+
+UPDATE_DURATION = Histogram('bot_update_duration_seconds', 'Time from webhook to handled update, queueing included',
+                            ('handler',))
+
+
+class UpdateQueueException(Exception):
+    pass
+
+
+# Every chat is pinned to one worker, so updates of a chat are handled strictly
+# in order while different chats are processed in parallel. Web workers each
+# run their own queue, so a chat's updates are also numbered in Redis as they
+# arrive, and each one waits until the previous one is handled in any process.
+class UpdateQueue(WorkerPool):
+    def __init__(self, app, workers=None, size=None):
+        super().__init__()
+        self.app = app
+        self.workers = workers or AppConfig.WEBHOOK_WORKERS
+        self.size = size or AppConfig.WEBHOOK_QUEUE_SIZE
+        self.queues = []
+        self.listeners = []
+
+    def start_workers(self):
+        self.queues = [queue.Queue(maxsize=self.size) for _ in range(self.workers)]
+
+        for index, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self.run, args=(worker_queue,), name=f'update-worker-{index}')
+            thread.daemon = True
+            thread.start()
+
+    def put(self, key, handler, *args):
+        self.start()
+
+        worker_queue = self.queues[hash(key) % self.workers]
+        ticket = self.get_ticket(key)
+
+        try:
+            worker_queue.put_nowait((key, ticket, handler, args, time.perf_counter()))
+        except queue.Full:
+            # Telegram delivers the update again, under a new number
+            self.mark_done(key, ticket)
+            raise UpdateQueueException('Update queue is full')
+
+    @staticmethod
+    def get_ticket(key):
+        try:
+            with get_redis().pipeline() as pipe:
+                pipe.incr(f'updates:{key}:queued')
+                pipe.expire(f'updates:{key}:queued', ORDER_KEY_TTL)
+                return pipe.execute()[0]
+        except RedisError as error:
+            logger.warning(f'Update order error: {error}')
+
+    @staticmethod
+    def wait_turn(key, ticket):
+        # Gives up after a while, so an update lost with a crashed process does
+        # not hold up the chat for good
+        deadline = time.monotonic() + AppConfig.UPDATE_ORDER_TIMEOUT
+
+        while ticket is not None and time.monotonic() < deadline:
+            try:
+                if int(get_redis().get(f'updates:{key}:done') or 0) >= ticket - 1:
+                    return
+            except RedisError as error:
+                logger.warning(f'Update order error: {error}')
+                return
+
+            time.sleep(0.01)
+
+        if ticket is not None:
+            logger.warning(f'Update {ticket} of {key} did not wait for the previous one')
+
+    @staticmethod
+    def mark_done(key, ticket):
+        if ticket is None:
+            return
+
+        try:
+            get_redis().eval(DONE_SCRIPT, 1, f'updates:{key}:done', ticket, ORDER_KEY_TTL)
+        except RedisError as error:
+            logger.warning(f'Update order error: {error}')
+
+    def get_depth(self):
+        return sum(worker_queue.qsize() for worker_queue in self.queues)
+
+    def join(self):
+        for worker_queue in self.queues:
+            worker_queue.join()
+
+    def run(self, worker_queue):
+        while True:
+            key, ticket, handler, args, queued_at = worker_queue.get()
+            self.wait_turn(key, ticket)
+
+            try:
+                with self.app.app_context(), track_queries('bot_update', scope_class, handler.__name__):
+                    handler(*args)
+            except Exception as error:
+                self.app.logger.exception(f'Update handling error: {error}')
+            finally:
+                self.mark_done(key, ticket)
+                self.observe(handler, time.perf_counter() - queued_at)
+                worker_queue.task_done()
+
+    def observe(self, handler, duration):
+        UPDATE_DURATION.observe(duration, handler.__name__)
+
+        for listener in self.listeners:
+            listener(handler, duration)
@@ -40,17 +40,53 @@
 # - POST /payment (check if the corresponding User and Record exist)
 
 import re
+import time
 import datetime as dt
 
 import telebot
-from flask import abort, request, redirect, render_template, session, url_for
-from sqlalchemy import desc, or_, and_, func
+from flask import Response, abort, g, request, redirect, render_template, session, url_for
+from sqlalchemy import desc, or_, and_
 
+from amortization import get_next_due_date
 from app import app, db
 from bot import bot
 from bot_handler import MessageHandler, CallbackHandler
 from config import AppConfig
+from metrics import Gauge, Histogram, collector, finish_scope, render, start_scope
 from models import User, Record, Payment, TypeEnum
+from pagination import KeysetPagination, PaginationException
+from query_debug import scope_class
+from services import PaymentService, PaymentServiceException, UserService, ForecastService, ForecastServiceException
+from update_queue import UpdateQueue, UpdateQueueException
+
+update_queue = UpdateQueue(app)
+
+HTTP_REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Flask request latency',
+                                  ('method', 'endpoint', 'status'))
+
+
+@collector
+def collect_update_queue():
+    depth = Gauge('update_queue_depth', 'Webhook updates waiting for a worker')
+    depth.set(update_queue.get_depth())
+    return [depth]
+
+
+@app.before_request
+def start_request_metrics():
+    g.metrics = (time.perf_counter(), *start_scope('http', scope_class, request.endpoint))
+
+
+@app.after_request
+def observe_request_metrics(response):
+    if metrics := g.pop('metrics', None):
+        start, scope, token = metrics
+        finish_scope(scope, token)
+        # Endpoint names, not URL rules: the webhook rule contains the bot token
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, request.method,
+                                      request.endpoint or 'unmatched', response.status_code)
+
+    return response
 
 
 def get_list(query):
@@ -58,17 +94,73 @@ def get_list(query):
     return [item.__dict__ for item in result]
 
 
-# Set up a route to handle Telegram updates
-@app.post(f'/{AppConfig.TELEGRAM_TOKEN}')
-def webhook():
-    bot.process_new_updates([telebot.types.Update.de_json(request.stream.read().decode("utf-8"))])
+def get_pagination(model):
+    try:
+        return KeysetPagination(model, request.values)
+    except PaginationException as error:
+        abort(400, str(error))
+
+
+def get_page(pagination, query, key=lambda row: row[0]):
+    try:
+        query = pagination.apply(query)
+    except PaginationException as error:
+        abort(400, str(error))
+
+    return pagination.paginate(db.session.execute(query).all(), key=key)
+
+
+# Form dropdowns are filled from these searches, so a page never carries more
+# than OPTIONS_LIMIT users or records whatever the size of the tables
+def get_options(query, id_column, text_column):
+    if search := request.args.get('q', '').strip():
+        condition = text_column.startswith(search, autoescape=True)
+        query = query.where(or_(condition, id_column == int(search)) if search.isdigit() else condition)
+
+    rows = db.session.execute(query.order_by(id_column).limit(AppConfig.OPTIONS_LIMIT)).all()
+    return [{'id': row[0], 'text': f'#{row[0]} {row[1]}'} for row in rows]
+
+
+# Payment rows with only the record and user columns the templates render,
+# so the payment pages never lazy-load Record or User per row
+def select_payments():
+    return db.select(
+        Payment.id,
+        Payment.amount,
+        Payment.remains,
+        Payment.payment_date,
+        Payment.created_at,
+        Payment.updated_at,
+        Record.id.label('record_id'),
+        Record.name.label('record_name'),
+        Record.amount.label('record_amount'),
+        Record.months,
+        Record.last_date,
+        User.id.label('user_id'),
+        User.username,
+    ).join(Record, Payment.record_id == Record.id).join(User, Record.user_id == User.id)
+
+
+def get_chat_id(data):
+    for key in ('message', 'edited_message', 'callback_query'):
+        if item := data.get(key):
+            chat = (item.get('message') or item).get('chat') or item.get('from') or {}
+            return chat.get('id')
+
+    return data.get('update_id')
+
+
+def enqueue_update(data, handler, *args):
+    try:
+        update_queue.put(get_chat_id(data), handler, *args)
+    except UpdateQueueException:
+        return 'Busy', 503
+
     return 'OK', 200
 
 
-@app.post(f'/{AppConfig.TELEGRAM_BOT_TOKEN}')
-def receive_data():
+def handle_update(data):
     handler = None
-    data = request.get_json()
 
     if message := data.get('edited_message'):
         edited_msg_handler = MessageHandler(message)
@@ -81,7 +173,18 @@ def receive_data():
     if handler:
         handler.handle()
 
-    return 'OK', 200
+
+# Set up a route to handle Telegram updates
+@app.post(f'/{AppConfig.TELEGRAM_TOKEN}')
+def webhook():
+    data = request.get_json(force=True)
+    return enqueue_update(data, bot.process_new_updates, [telebot.types.Update.de_json(data)])
+
+
+@app.post(f'/{AppConfig.TELEGRAM_BOT_TOKEN}')
+def receive_data():
+    data = request.get_json()
+    return enqueue_update(data, handle_update, data)
 
 
 @app.get('/users')
@@ -89,27 +192,30 @@ def user_list():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    filters = request.values
-
-    try:
-        cnt = int(filters.get('size')) if filters.get('size') else None
-    except ValueError:
-        abort(400, 'Invalid size value')
+    pagination = get_pagination(User)
 
     columns = ['id', 'username', 'first_name', 'last_name', 'phone']
-    query = db.select(User).limit(cnt) if cnt else db.select(User)
-    users = get_list(query)
+    users = [row[0].__dict__ for row in get_page(pagination, db.select(User))]
 
     context = {
         'title': 'User List',
         'active': 'users',
         'users': users,
-        'keys': columns
+        'keys': columns,
+        **pagination.get_context()
     }
 
     return render_template('user/list.html', **context), 200
 
 
+@app.get('/users/options')
+def user_options():
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    return get_options(db.select(User.id, User.username), User.id, User.username)
+
+
 @app.get('/users/<user_id>')
 def user_detail(user_id):
     if 'username' not in session:
@@ -165,9 +271,11 @@ def user_create():
 @app.delete("/users/<int:user_id>")
 def user_delete(user_id):
     user = db.get_or_404(User, user_id)
+    tg_id = user.tg_id
 
     db.session.delete(user)
     db.session.commit()
+    UserService.forget(tg_id)
 
     # return redirect(url_for("user_list"))
     return 'OK', 200
@@ -178,28 +286,48 @@ def record_list():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    filters = request.values
-    try:
-        cnt = int(filters.get('size')) if filters.get('size') else None
-    except ValueError:
-        abort(400, 'Invalid size value')
+    pagination = get_pagination(Record)
 
     columns = ['id', 'user_id', 'type', 'name', 'amount', 'remains', 'months', 'payment_amount', 'payment_day', 'last_date']
-    query = db.select(Record).limit(cnt) if cnt else db.select(Record)
-    records = get_list(query)
+    records = [row[0].__dict__ for row in get_page(pagination, db.select(Record))]
+
+    try:
+        portfolio, portfolio_error = ForecastService().get_cached_portfolio(), ''
+    except ForecastServiceException as error:
+        db.session.rollback()
+        app.logger.error(str(error))
+        portfolio, portfolio_error = None, str(error)
 
     context = {
         'title': 'Record List',
         'active': 'records',
         'records': records,
-        'users': db.session.query(User).all(),
         'types': [item for item in TypeEnum],
-        'keys': columns
+        'keys': columns,
+        'portfolio': portfolio,
+        'portfolio_error': portfolio_error,
+        **pagination.get_context()
     }
 
     return render_template('record/list.html', **context), 200
 
 
+@app.get('/records/options')
+def record_options():
+    if 'username' not in session:
+        return redirect(url_for('login'))
+
+    query = db.select(Record.id, Record.name)
+
+    if user_id := request.args.get('user_id'):
+        try:
+            query = query.where(Record.user_id == int(user_id))
+        except ValueError:
+            abort(400, 'Invalid user_id value')
+
+    return get_options(query, Record.id, Record.name)
+
+
 @app.get('/records/<record_id>')
 def record_detail(record_id):
     if 'username' not in session:
@@ -248,6 +376,9 @@ def record_create():
             payment_amount=data["payment_amount"],
             payment_day=data["payment_day"],
             last_date=data["last_date"],
+            next_due_date=get_next_due_date(
+                data["amount"], data["months"], data["payment_amount"], data["payment_day"], data["last_date"]
+            ),
         )
 
         db.session.add(record)
@@ -258,7 +389,6 @@ def record_create():
     context = {
         'title': 'Create Record',
         'active': 'records',
-        'users': db.session.query(User).all(),
         'types': [item for item in TypeEnum],
     }
 
@@ -281,36 +411,18 @@ def payment_list():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    filters = request.values
-    try:
-        cnt = int(filters.get('size')) if filters.get('size') else None
-    except ValueError:
-        abort(400, 'Invalid size value')
+    pagination = get_pagination(Payment)
 
     columns = ['id', 'record', 'username', 'amount', 'months', 'payment_amount', 'remains', 'payment_date', 'last_date']
 
-    # First solution
-    # query = db.session
-    #     .query(Payment.id, Record.id, Record.name, User.id, User.username, Payment.payment_date)\
-    #     .join(Record).join(User).limit(cnt if cnt else -1)
-
-    # Second solution
-    if cnt:
-        query = db.session.query(Payment, Record).join(Record).limit(cnt)
-    else:
-        query = db.session.query(Payment, Record).join(Record)
-    payments = query.all()
-
-    records = get_list(db.select(Record))
-    users = get_list(db.select(User))
+    payments = get_page(pagination, select_payments(), key=lambda row: row)
 
     context = {
         'title': 'Payment List',
         'active': 'payments',
         'payments': payments,
         'keys': columns,
-        'records': records,
-        'users': users
+        **pagination.get_context()
     }
 
     return render_template('payment/list.html', **context), 200
@@ -321,12 +433,15 @@ def payment_detail(payment_id):
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    result = db.get_or_404(Payment, payment_id)
-    query = db.session.query(Payment, Record).join(Record).filter(Payment.id == payment_id).limit(1)
+    payment = db.session.execute(select_payments().where(Payment.id == payment_id)).first()
+
+    if payment is None:
+        abort(404)
+
     context = {
         'title': 'Payment Details',
         'active': 'payments',
-        'payment': query.all()
+        'payment': payment
     }
 
     return render_template('payment/detail.html', **context), 200
@@ -346,15 +461,11 @@ def payment_create():
         except ValueError:
             return 'Invalid record_id or user_id value', 400
 
-        record = db.session.query(Record).get(record_id)
-        payed = db.session.query(func.sum(Payment.amount)).filter(Payment.record_id == record_id).one()
-
-        remains = record.amount - float(data['amount'])
-
-        if payed[0]:
-            remains -= payed[0]
-
-        record.remains = remains
+        try:
+            remains = PaymentService.update_paid_total(record_id, float(data['amount']))
+        except PaymentServiceException as error:
+            db.session.rollback()
+            return str(error), 404
 
         payment = Payment(
             user_id=user_id,
@@ -369,14 +480,9 @@ def payment_create():
 
         return redirect(url_for('payment_detail', payment_id=payment.id))
 
-    records = get_list(db.select(Record))
-    users = get_list(db.select(User))
-
     context = {
         'title': 'Create Payment',
         'active': 'payments',
-        'records': records,
-        'users': users
     }
 
     return render_template("payment/create.html", **context)
@@ -386,6 +492,7 @@ def payment_create():
 def payment_delete(payment_id):
     payment = db.get_or_404(Payment, payment_id)
 
+    PaymentService.update_paid_total(payment.record_id, -payment.amount)
     db.session.delete(payment)
     db.session.commit()
 
@@ -467,6 +574,11 @@ def server_error(error):
     return get_error_content('Server Error', error, '50x'), 500
 
 
+@app.get('/metrics')
+def metrics_page():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/')
 def home_page():
     app.logger.info('GET Home page')
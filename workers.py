@@ -0,0 +1,21 @@
+import os
+import threading
+
+
+# Background threads of a queue. Threads do not survive fork, so the pool is
+# started lazily on first use and once more in every forked process.
+class WorkerPool:
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            self.start_workers()
+            self.pid = os.getpid()
+
+    def start_workers(self):
+        raise NotImplementedError